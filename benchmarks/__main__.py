@@ -0,0 +1,44 @@
+"""
+Runs the benchmark suites and compares the results with the saved baselines.
+
+Usage: python -m benchmarks [--save] [--check] [--min-time SECONDS] [suite ...]
+
+Run from the repository root. Results depend on the machine, the dictionary version and the hash seed
+(set PYTHONHASHSEED for repeatable runs), so compare baselines saved on the same machine.
+"""
+
+import argparse
+import sys
+
+from . import common
+
+SUITES = ["dictionary", "proofread", "server", "xifan"]
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("suites", nargs="*", metavar="suite", help="dictionary, proofread, server or xifan (default: all)")
+    parser.add_argument("--min-time", type=float, default=1.0, help="seconds to run each case")
+    parser.add_argument("--save", action="store_true", help="save the results as the new baselines")
+    parser.add_argument("--check", action="store_true", help="exit with status 1 if a case is slower than its baseline")
+    args = parser.parse_args()
+    unknown = set(args.suites) - set(SUITES)
+    if unknown:
+        parser.error("unknown suites: " + ", ".join(sorted(unknown)))
+
+    slower = []
+    for suite in args.suites or SUITES:
+        module = __import__(f"benchmarks.{suite}", fromlist=["run_suite"])
+        results = module.run_suite(args.min_time)
+        baseline = common.load_baseline(suite)
+        common.report(suite, results, baseline)
+        slower += [f"{suite}: {name}" for name in common.regressions(results, baseline)]
+        if args.save:
+            common.save_baseline(suite, results)
+
+    if slower:
+        print("Slower than the baseline:", ", ".join(slower))
+        if args.check:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
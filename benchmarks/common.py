@@ -0,0 +1,168 @@
+"""
+Measuring throughput, latency percentiles and peak memory, and comparing the results with saved baselines.
+"""
+
+import gc
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), "baselines")
+
+# a case is slower than its baseline if its throughput is lower than this fraction of the baseline
+REGRESSION_THRESHOLD = 0.9
+
+Result = Dict[str, Any]
+
+def percentile(sorted_values: Sequence[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))]
+
+def summarize(name: str, latencies: List[float], elapsed: float, peak_memory: int) -> Result:
+    latencies.sort()
+    return {
+        "name": name,
+        "calls": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "peak_memory_kib": peak_memory / 1024,
+    }
+
+def measure_memory(f: Callable[[Any], Any], inputs: Sequence[Any]) -> int:
+    """
+    Returns the peak memory allocated while calling f once with each input, in bytes.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        for item in inputs:
+            f(item)
+
+        return tracemalloc.get_traced_memory()[1]
+
+    finally:
+        tracemalloc.stop()
+
+def run(name: str, f: Callable[[Any], Any], inputs: Sequence[Any], min_time: float = 1.0, setup: Optional[Callable[[], None]] = None) -> Result:
+    """
+    Calls f with the inputs in turn for at least min_time seconds and measures the latency of each call.
+    `setup` is called before measuring the memory and before measuring the time, eg. to clear caches.
+    """
+    if setup:
+        setup()
+
+    peak_memory = measure_memory(f, inputs)
+    if setup:
+        setup()
+
+    latencies: List[float] = []
+    start = time.perf_counter()
+    while True:
+        for item in inputs:
+            call_start = time.perf_counter()
+            f(item)
+            latencies.append(time.perf_counter() - call_start)
+
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return summarize(name, latencies, elapsed, peak_memory)
+
+async def run_async(name: str, f: Callable[[Any], Awaitable[Any]], inputs: Sequence[Any], min_time: float = 1.0, setup: Optional[Callable[[], None]] = None) -> Result:
+    """
+    Like run, but for coroutine functions. The peak memory is that of the whole process, including the server.
+    """
+    if setup:
+        setup()
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        for item in inputs:
+            await f(item)
+
+        peak_memory = tracemalloc.get_traced_memory()[1]
+
+    finally:
+        tracemalloc.stop()
+
+    if setup:
+        setup()
+
+    latencies: List[float] = []
+    start = time.perf_counter()
+    while True:
+        for item in inputs:
+            call_start = time.perf_counter()
+            await f(item)
+            latencies.append(time.perf_counter() - call_start)
+
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return summarize(name, latencies, elapsed, peak_memory)
+
+def environment() -> Dict[str, Any]:
+    """
+    Describes where the results were measured, so that baselines are only compared with care.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    import yajwiz
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "dictionary_version": yajwiz.load_dictionary().version,
+        "hash_seed": os.environ.get("PYTHONHASHSEED"),
+    }
+
+def report(suite: str, results: List[Result], baseline: Optional[Dict[str, Any]] = None):
+    baseline_results = {result["name"]: result for result in baseline["results"]} if baseline else {}
+    print(f"== {suite}")
+    print(f"{'case':<32} {'calls/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'peak KiB':>10} {'vs baseline':>12}")
+    for result in results:
+        comparison = ""
+        if result["name"] in baseline_results:
+            ratio = result["throughput"] / baseline_results[result["name"]]["throughput"]
+            comparison = f"{ratio:>6.2f}x" + (" SLOWER" if ratio < REGRESSION_THRESHOLD else "")
+
+        print(f"{result['name']:<32} {result['throughput']:>10.1f} {result['p50_ms']:>9.3f} {result['p99_ms']:>9.3f} {result['peak_memory_kib']:>10.1f} {comparison:>12}")
+
+def baseline_path(suite: str) -> str:
+    return os.path.join(BASELINE_DIR, suite + ".json")
+
+def load_baseline(suite: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(baseline_path(suite)) as f:
+            return json.load(f)
+
+    except FileNotFoundError:
+        return None
+
+def save_baseline(suite: str, results: List[Result]):
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    with open(baseline_path(suite), "w") as f:
+        json.dump({"environment": environment(), "results": results}, f, indent=2)
+        f.write("\n")
+
+def regressions(results: List[Result], baseline: Optional[Dict[str, Any]]) -> List[str]:
+    if not baseline:
+        return []
+
+    baseline_results = {result["name"]: result for result in baseline["results"]}
+    return [
+        result["name"]
+        for result in results
+        if result["name"] in baseline_results and result["throughput"] < REGRESSION_THRESHOLD * baseline_results[result["name"]]["throughput"]
+    ]
@@ -0,0 +1,38 @@
+"""
+dictionary_query with a mix of realistic queries.
+
+Usage: python -m benchmarks dictionary
+"""
+
+from typing import Dict, List
+
+from klingonia import dictionary, memo
+
+from . import common
+
+QUERY_MIX: Dict[str, List[str]] = {
+    "bare words": ["a", "qa", "ghom", "water", "be'", "Qapla'", "ship", "tlhIngan"],
+    "tlh: regexes": ["tlh:^qa", "tlh:ngh$", "tlh:\"^bach$\"", "tlh:^[bD]a", "tlh:'$"],
+    "pos: filters": ["pos:v tlh:^gh", "pos:n en:ship", "pos:adv", "pos:v:is tlh:^Q"],
+    "boolean combinations": ["water OR fire", "NOT pos:v tlh:^q", "(en:ship OR en:boat) pos:n", "ghom AND pos:v", "en:warrior TAI en:honor"],
+    "sentences": ["tlhIngan Hol Dajatlh'a'", "qaleghneS", "Heghlu'meH QaQ jajvam", "nuqDaq 'oH puchpa''e'", "jIyajbe'"],
+}
+
+def clear_caches():
+    dictionary.render_cache.clear()
+    memo.analysis_cache.clear()
+    memo.errors_cache.clear()
+    dictionary.compile_query.cache_clear()
+    dictionary.fix_xifan.cache_clear()
+
+def run_suite(min_time: float) -> List[common.Result]:
+    results = []
+    for category, queries in QUERY_MIX.items():
+        results.append(common.run(category, lambda query: dictionary.dictionary_query(query, "en", "html"), queries, min_time, setup=clear_caches))
+
+    all_queries = [query for queries in QUERY_MIX.values() for query in queries]
+    # every call starts with empty caches
+    results.append(common.run("all, cold caches", lambda query: (clear_caches(), dictionary.dictionary_query(query, "en", "html")), all_queries, min_time))
+    results.append(common.run("all, top 10 by relevance", lambda query: dictionary.dictionary_query(query, "en", "html", limit=10, rank=True), all_queries, min_time, setup=clear_caches))
+    results.append(common.run("all, latex", lambda query: dictionary.dictionary_query(query, "en", "latex"), all_queries, min_time, setup=clear_caches))
+    return results
@@ -0,0 +1,46 @@
+"""
+Proofreader throughput on multi-kilobyte texts.
+
+Usage: python -m benchmarks proofread
+"""
+
+from typing import List
+
+import yajwiz
+
+from klingonia import memo
+from klingonia.proofread import check_and_render, render_line
+
+from . import common
+
+SIZES = [1024, 4096, 16384, 65536]
+
+def make_corpus(size: int) -> str:
+    """
+    Builds a text of about `size` characters from the example sentences of the dictionary.
+    """
+    sentences = [entry.name for entry in yajwiz.load_dictionary().entries.values() if "sen" in entry.tags]
+    lines: List[str] = []
+    length = 0
+    i = 0
+    while length < size:
+        line = " ".join(sentences[(i+j) % len(sentences)] for j in range(3))
+        lines.append(line)
+        length += len(line) + 1
+        i += 3
+
+    return "\n".join(lines)
+
+def run_suite(min_time: float) -> List[common.Result]:
+    results = []
+    for size in SIZES:
+        text = make_corpus(size)
+        lines = [line for line in text.split("\n") if line.strip()]
+        errors = [yajwiz.get_errors(line) for line in lines]
+
+        # the memo is cleared before every call, so that each line is checked
+        results.append(common.run(f"check_and_render {size}", lambda text: (memo.errors_cache.clear(), check_and_render(text)), [text], min_time))
+        results.append(common.run(f"check_and_render {size}, memo", check_and_render, [text], min_time, setup=memo.errors_cache.clear))
+        results.append(common.run(f"render only {size}", lambda _: [render_line(line, line_errors) for line, line_errors in zip(lines, errors)], [None], min_time))
+
+    return results
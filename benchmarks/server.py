@@ -0,0 +1,55 @@
+"""
+The aiohttp routes, requested through an in-process test client.
+
+Usage: python -m benchmarks server
+"""
+
+import asyncio
+import logging
+from typing import Any, Callable, List, Tuple
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from klingonia import httpcache, memo, templating
+
+from . import common
+from .proofread import make_corpus
+
+def clear_caches():
+    from klingonia import reload
+    reload.current().render_cache.clear()
+    memo.analysis_cache.clear()
+    memo.errors_cache.clear()
+    httpcache.response_cache.clear()
+    templating.fragment_cache.clear()
+
+async def run_routes(min_time: float) -> List[common.Result]:
+    # the server module reads its configuration when it is imported
+    from klingonia.server import make_app
+    logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+    text = make_corpus(4096)
+    async with TestClient(TestServer(make_app())) as client:
+        async def get(path: str):
+            async with client.get(path) as response:
+                assert response.status == 200, (path, response.status)
+                await response.read()
+
+        async def post(path: str, data: str):
+            async with client.post(path, data=data.encode("utf-8")) as response:
+                assert response.status == 200, (path, response.status)
+                await response.read()
+
+        cases: List[Tuple[str, Callable[[Any], Any], List[Any]]] = [
+            ("GET /api/dictionary", lambda q: get("/api/dictionary?q=" + q), ["ghom", "tlh:^qa", "pos:n en:ship", "qaleghneS"]),
+            ("GET /api/dictionary ndjson", lambda q: get("/api/dictionary?stream=ndjson&q=" + q), ["ghom", "tlh:^qa", "pos:n en:ship", "qaleghneS"]),
+            ("GET /api/dictionary short", lambda q: get("/api/dictionary?sort=relevance&limit=10&q=" + q), ["a", "q", "e"]),
+            ("GET /dictionary", lambda q: get("/dictionary?q=" + q), ["ghom", "tlh:^qa", "qaleghneS"]),
+            ("GET /api/analyze", lambda word: get("/api/analyze?word=" + word), ["qaleghneS", "jIyajbe'", "Heghlu'meH"]),
+            ("POST /api/proofread 4k", lambda text: post("/api/proofread", text), [text]),
+            ("POST /api/grammar_check 4k", lambda text: post("/api/grammar_check", text), [text]),
+            ("GET /", lambda path: get(path), ["/"]),
+        ]
+        return [await common.run_async(name, f, inputs, min_time, setup=clear_caches) for name, f, inputs in cases]
+
+def run_suite(min_time: float) -> List[common.Result]:
+    return asyncio.new_event_loop().run_until_complete(run_routes(min_time))
@@ -0,0 +1,49 @@
+"""
+fix_xifan compared with the original implementation of eight substitutions. tests/test_xifan.py checks that both give
+the same results.
+
+Usage: python -m benchmarks xifan
+"""
+
+import re
+from typing import List
+
+from klingonia.dictionary import dictionary, fix_xifan, fix_xifan_all
+
+from . import common
+
+def fix_xifan_reference(query: str) -> str:
+    query = re.sub(r"i", "I", query)
+    query = re.sub(r"d", "D", query)
+    query = re.sub(r"s", "S", query)
+    query = re.sub(r"([^cgl]|[^t]l|^)h", r"\1H", query)
+    query = re.sub(r"x", "tlh", query)
+    query = re.sub(r"f", "ng", query)
+    query = re.sub(r"c(?!h)", "ch", query)
+    query = re.sub(r"(?<!n)g(?!h)", "gh", query)
+    return query
+
+def dictionary_texts() -> List[str]:
+    texts: List[str] = []
+    for entry in dictionary.entries.values():
+        texts += [entry.id, entry.name]
+        for field in [entry.definition, entry.notes, entry.examples]:
+            texts += field.values()
+
+        for tags in entry.search_tags.values():
+            texts += tags
+
+        texts += [text for text in [entry.synonyms, entry.antonyms, entry.see_also, entry.components, entry.source] if text]
+
+    return texts
+
+def run_suite(min_time: float) -> List[common.Result]:
+    results = []
+    names = [entry.name.lower() for entry in dictionary.entries.values()]
+    for label, words in [("dictionary names", names), ("dictionary texts", dictionary_texts())]:
+        results.append(common.run(f"reference, {label}", lambda words: [fix_xifan_reference(word) for word in words], [words], min_time))
+        results.append(common.run(f"fix_xifan, {label}", lambda words: [fix_xifan(word) for word in words], [words], min_time))
+        results.append(common.run(f"uncached, {label}", lambda words: [fix_xifan.__wrapped__(word) for word in words], [words], min_time))
+        results.append(common.run(f"fix_xifan_all, {label}", fix_xifan_all, [words], min_time))
+
+    return results
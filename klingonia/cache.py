@@ -0,0 +1,111 @@
+from collections import OrderedDict
+import sys
+import threading
+import time
+from typing import Any, Dict, Hashable, Optional
+
+def estimate_size(value: Any) -> int:
+    """
+    Estimates the memory used by a value consisting of dicts, lists, tuples, sets and scalars.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += estimate_size(key) + estimate_size(item)
+
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += estimate_size(item)
+
+    return size
+
+class LRUCache:
+    """
+    A thread-safe least-recently-used cache bounded by the estimated memory size of its values.
+    Items can have a time to live in seconds (`ttl`, by default the ttl of the cache, or None for no limit).
+    The cache is cleared whenever it is used with a different dictionary version.
+    """
+
+    def __init__(self, max_bytes: int, ttl: Optional[float] = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.version: Optional[str] = None
+        self.items: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.sizes: Dict[Hashable, int] = {}
+        self.expires: Dict[Hashable, float] = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+
+    def check_version(self, version: str):
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return None
+
+            if key in self.expires and self.expires[key] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key: Hashable, value: Any, size: Optional[int] = None, ttl: Optional[float] = None):
+        if size is None:
+            size = estimate_size(value)
+
+        if ttl is None:
+            ttl = self.ttl
+
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.items:
+                self._remove(key)
+
+            self.items[key] = value
+            self.sizes[key] = size
+            self.bytes += size
+            if ttl is not None:
+                self.expires[key] = time.monotonic() + ttl
+
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.items)))
+                self.evictions += 1
+
+    def _remove(self, key: Hashable):
+        del self.items[key]
+        self.bytes -= self.sizes.pop(key)
+        self.expires.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.sizes.clear()
+            self.expires.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.items),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,175 @@
+"""
+Content encoding of responses.
+
+Static files have gzip and brotli variants, which are built with `python -m klingonia.compression static/`
+next to the originals (style.css.gz, style.css.br), or compressed when the file is first served if they have not
+been built. Large dynamic responses
+are compressed in the default executor, so that compressing does not block the event loop.
+
+Brotli is used if the brotli module (brotlipy) is installed.
+"""
+
+import asyncio
+import gzip
+import os
+import sys
+from typing import Collection, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+try:
+    import brotli # type: ignore
+except ImportError:
+    brotli = None
+
+# bodies shorter than this are not compressed
+MIN_COMPRESS_SIZE = 1024
+
+# content types of dynamic responses that are compressed
+COMPRESSED_TYPES = {"text/html", "text/plain", "text/css", "application/json", "application/x-ndjson", "image/svg+xml"}
+
+# the supported encodings in order of preference, with the file extensions of their variants
+ENCODINGS: List[Tuple[str, str]] = ([("br", ".br")] if brotli else []) + [("gzip", ".gz")]
+
+def compress(body: bytes, encoding: str, best: bool = False) -> bytes:
+    """
+    Compresses the body fast enough for dynamic responses, or as well as possible if `best` is set.
+    """
+    if encoding == "br":
+        return brotli.compress(body, quality=11 if best else 5)
+
+    return gzip.compress(body, compresslevel=9 if best else 6)
+
+def compress_all(body: bytes, best: bool = False) -> Dict[str, bytes]:
+    """
+    Returns the variants of the body in the supported encodings that are smaller than the body.
+    """
+    variants = {}
+    for encoding, _ in ENCODINGS:
+        encoded = compress(body, encoding, best)
+        if len(encoded) < len(body):
+            variants[encoding] = encoded
+
+    return variants
+
+async def compress_all_async(body: bytes) -> Dict[str, bytes]:
+    if len(body) < MIN_COMPRESS_SIZE:
+        return {}
+
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, compress_all, body)
+
+def accepted_encoding(request: web.Request, available: Collection[str]) -> Optional[str]:
+    """
+    Chooses the available encoding that the client prefers (by its q-value, then by our preference), or None for identity.
+    """
+    weights: Dict[str, float] = {}
+    for coding in request.headers.get("Accept-Encoding", "").split(","):
+        name, _, parameters = coding.strip().partition(";")
+        weight = 1.0
+        parameters = parameters.replace(" ", "")
+        if parameters.startswith("q="):
+            try:
+                weight = float(parameters[2:])
+
+            except ValueError:
+                weight = 0.0
+
+        weights[name.strip().lower()] = weight
+
+    best = None
+    best_weight = 0.0
+    for encoding, _ in ENCODINGS:
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if encoding in available and weight > best_weight:
+            best = encoding
+            best_weight = weight
+
+    return best
+
+def load_variants(path: str) -> Tuple[bytes, Dict[str, bytes]]:
+    """
+    Reads a static file and its variants that have been built and are not older than the file, and compresses the rest.
+    """
+    with open(path, "rb") as f:
+        body = f.read()
+
+    variants = {}
+    mtime = os.stat(path).st_mtime_ns
+    for encoding, extension in ENCODINGS:
+        try:
+            if os.stat(path + extension).st_mtime_ns >= mtime:
+                with open(path + extension, "rb") as f:
+                    variants[encoding] = f.read()
+
+                continue
+
+        except OSError:
+            pass
+
+        encoded = compress(body, encoding, best=True)
+        if len(encoded) < len(body):
+            variants[encoding] = encoded
+
+    return body, variants
+
+def is_variant(path: str) -> bool:
+    return path.endswith(tuple(extension for _, extension in ENCODINGS))
+
+def add_vary(response: web.StreamResponse):
+    vary = response.headers.get("Vary", "")
+    if "accept-encoding" not in vary.lower():
+        response.headers["Vary"] = (vary + ", " if vary else "") + "Accept-Encoding"
+
+@web.middleware
+async def compress_responses(request: web.Request, handler):
+    """
+    Compresses large dynamic responses in the default executor. Streamed responses are not compressed.
+    """
+    response = await handler(request)
+    if (
+        type(response) is not web.Response
+        or response.status != 200
+        or "Content-Encoding" in response.headers
+        or response.content_type not in COMPRESSED_TYPES
+        or not isinstance(response.body, bytes)
+        or len(response.body) < MIN_COMPRESS_SIZE
+    ):
+        return response
+
+    add_vary(response)
+    encoding = accepted_encoding(request, [encoding for encoding, _ in ENCODINGS])
+    if encoding is None:
+        return response
+
+    loop = asyncio.get_event_loop()
+    encoded = await loop.run_in_executor(None, compress, response.body, encoding)
+    if len(encoded) < len(response.body):
+        response.body = encoded
+        response.headers["Content-Encoding"] = encoding
+
+    return response
+
+def build_static(directory: str):
+    """
+    Writes the compressed variants of the files in a directory next to them.
+    """
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            if is_variant(path):
+                continue
+
+            with open(path, "rb") as f:
+                body = f.read()
+
+            for encoding, extension in ENCODINGS:
+                encoded = compress(body, encoding, best=True)
+                if len(encoded) < len(body):
+                    with open(path + extension, "wb") as f:
+                        f.write(encoded)
+
+                    print(f"{path + extension}: {len(body)} -> {len(encoded)} bytes")
+
+if __name__ == "__main__":
+    build_static(sys.argv[1] if len(sys.argv) > 1 else "static/")
@@ -1,57 +1,655 @@
+from abc import ABC, abstractmethod
+import functools
+import heapq
+import itertools
 import logging
+import os
+import pickle
 import re
+import struct
 import sys
-from typing import Collection, DefaultDict, Dict, Callable, Any, List, Literal, Set
+import threading
+import time
+from typing import Collection, DefaultDict, Dict, Callable, Any, Iterable, Iterator, List, Literal, NamedTuple, Optional, Set, Tuple
 
+import appdirs
 import yajwiz
 from yajwiz import BoqwizEntry
 
-from . import locales
+from . import locales, memo, metrics
+from .cache import LRUCache
+from .indexes import NgramIndex, PrefixIndex
+from .prerender import PrerenderedEntries, write_prerendered
+from .snapshot import LazySections, Snapshot, write_snapshot
+from .store import EntryStore
 
 logger = logging.getLogger("dictionary")
 
 dictionary = yajwiz.load_dictionary()
+# the analyzer of this dictionary version (reload.py loads a new module for a new version)
+analyzer = yajwiz.analyzer
 
-derived_index = DefaultDict[str, List[BoqwizEntry]](list)
+RENDER_CACHE_SIZE = 64 * 1024 * 1024
 
-def make_derived_index():
-    global derived_index
-    for entry in dictionary.entries.values():
-        if "sen" in entry.tags:
-            continue
+# rendered entries by (entry id, language, link format, include_derivs), shared by all queries
+render_cache = LRUCache(RENDER_CACHE_SIZE)
+
+# optional table of prerendered entries, see load_prerendered
+prerendered: Optional[PrerenderedEntries] = None
+
+# derived entries and search tags by entry position, see store.py
+entry_store: EntryStore
+
+def make_entry_store():
+    global entry_store
+    entry_store = EntryStore(dictionary, get_links)
+
+def derived_entries(entry: BoqwizEntry) -> List[BoqwizEntry]:
+    return [entry_list[position] for position in entry_store.derived_positions(entry.id)]
+
+# entries in dictionary iteration order; the search indexes refer to entries by their position in this list
+entry_list: List[BoqwizEntry] = []
+name_index = NgramIndex([])
+prefix_indexes: Dict[str, PrefixIndex] = {}
+field_indexes: Dict[str, NgramIndex] = {}
+
+# Maps an operator name to a function that returns the positions of the candidate entries for an argument,
+# or None if the argument cannot be looked up from the indexes
+QUERY_INDEXES: Dict[str, Callable[[str], Optional[Set[int]]]] = {}
+
+def make_field_index(get_text: Callable[[BoqwizEntry], str]) -> NgramIndex:
+    return NgramIndex(((position, get_text(entry)) for position, entry in enumerate(entry_list)), min_n=3)
+
+def make_search_indexes():
+    global entry_list, name_index, prefix_indexes, field_indexes
+    entry_list = list(dictionary.entries.values())
+    name_index = NgramIndex(enumerate(entry.name for entry in entry_list))
+    prefix_indexes = {}
+    field_indexes = {}
+    for language in dictionary.locales:
+        prefix_indexes[language] = PrefixIndex(
+            (position, token)
+            for position, entry in enumerate(entry_list)
+            for token in [tag.lower() for tag in entry.search_tags.get(language, [])] + entry.definition.get(language, "").lower().split()
+        )
+        field_indexes["definition:" + language] = make_field_index(lambda entry: entry.definition.get(language, ""))
+        field_indexes["notes:" + language] = make_field_index(lambda entry: entry.notes.get(language, ""))
+        field_indexes["examples:" + language] = make_field_index(lambda entry: entry.examples.get(language, ""))
+
+    for field in ["antonyms", "synonyms", "components", "see_also"]:
+        field_indexes[field] = make_field_index(lambda entry: getattr(entry, field) or "")
+
+    init_query_indexes()
+
+# bump when the structure of the indexes changes
+SNAPSHOT_FORMAT = 3
+
+# the indexes are saved here after they have been built, and loaded from here at startup; set to "" to disable
+SNAPSHOT_PATH = os.environ.get("KLINGONIA_SNAPSHOT", os.path.join(appdirs.user_cache_dir("klingonia"), "snapshot.bin"))
+
+def save_snapshot(path: str):
+    def sections():
+        yield "entry_store", entry_store
+        yield "name_index", name_index
+        for language in dictionary.locales:
+            yield "prefix:" + language, prefix_indexes[language]
+        
+        for name, index in field_indexes.items():
+            yield "field:" + name, index
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    write_snapshot(path, {"format": SNAPSHOT_FORMAT, "version": dictionary.version}, sections())
+
+def load_snapshot(path: str) -> bool:
+    """
+    Loads the derived and search indexes from a snapshot. Returns False if the snapshot is missing or outdated.
+    Per-language and per-field indexes are loaded when they are first used.
+    """
+    global entry_store, entry_list, name_index, prefix_indexes, field_indexes
+    try:
+        snapshot = Snapshot(path)
+        if snapshot.header != {"format": SNAPSHOT_FORMAT, "version": dictionary.version}:
+            return False
+        
+        new_entry_store = snapshot.load("entry_store")
+        new_name_index = snapshot.load("name_index")
+    
+    except FileNotFoundError:
+        return False
+    
+    except (OSError, ValueError, EOFError, pickle.UnpicklingError, struct.error):
+        # a truncated or corrupt snapshot
+        logger.exception("Could not read the index snapshot %s, rebuilding the indexes", path, exc_info=sys.exc_info())
+        return False
+    
+    entry_store = new_entry_store
+    entry_list = [dictionary.entries[entry_id] for entry_id in entry_store.ids]
+    name_index = new_name_index
+    prefix_indexes = LazySections(snapshot, "prefix:")
+    field_indexes = LazySections(snapshot, "field:")
+    init_query_indexes()
+    return True
+
+def load_all_sections():
+    """
+    Loads the indexes of the snapshot that have not been used yet, e.g. before forking processes that share them.
+    """
+    for indexes in [prefix_indexes, field_indexes]:
+        if isinstance(indexes, LazySections):
+            indexes.load_all()
+
+def init_indexes():
+    if SNAPSHOT_PATH and load_snapshot(SNAPSHOT_PATH):
+        return
+    
+    make_entry_store()
+    make_search_indexes()
+    if SNAPSHOT_PATH:
+        try:
+            save_snapshot(SNAPSHOT_PATH)
+        
+        except OSError:
+            logger.exception("Could not save the index snapshot to %s", SNAPSHOT_PATH, exc_info=sys.exc_info())
+
+def init_query_indexes():
+    QUERY_INDEXES.clear()
+    QUERY_INDEXES["tlh"] = lambda arg: name_index.regex_candidates(fix_xifan(arg))
+    # "notes" is case-insensitive and cannot be looked up from the index
+    QUERY_INDEXES["ex"] = lambda arg: field_indexes["examples:en"].regex_candidates(arg)
+    QUERY_INDEXES["antonym"] = lambda arg: field_indexes["antonyms"].regex_candidates(fix_xifan(arg))
+    QUERY_INDEXES["synonym"] = lambda arg: field_indexes["synonyms"].regex_candidates(fix_xifan(arg))
+    QUERY_INDEXES["components"] = lambda arg: field_indexes["components"].regex_candidates(fix_xifan(arg))
+    QUERY_INDEXES["see"] = lambda arg: field_indexes["see_also"].regex_candidates(fix_xifan(arg))
+    for language in dictionary.locales:
+        add_query_indexes(language)
+
+def add_query_indexes(language: str):
+    def definition_candidates(arg: str) -> Optional[Set[int]]:
+        candidates = field_indexes["definition:" + language].regex_candidates(arg)
+        if candidates is None:
+            return None
+
+        return candidates.union(entry_store.search_tags[language].get(arg))
+
+    QUERY_INDEXES[language] = definition_candidates
+    QUERY_INDEXES[language+"notes"] = lambda arg: field_indexes["notes:" + language].regex_candidates(arg)
+    QUERY_INDEXES[language+"ex"] = lambda arg: field_indexes["examples:" + language].regex_candidates(arg)
+
+QueryPredicate = Callable[[BoqwizEntry], Any]
 
-        for component in get_links(entry.components or ""):
-            derived_index[component].append(entry)
-            if component.count(":") == 1:
-                derived_index[component + ":1"].append(entry)
-
-
-QUERY_OPERATORS: Dict[str, Callable[[BoqwizEntry, str], Any]] = {
-    "tlh": lambda entry, arg: re.search(fix_xifan(arg), entry.name),
-    "notes": lambda entry, arg: re.search(arg, entry.notes.get("en", ""), re.IGNORECASE),
-    "ex": lambda entry, arg: re.search(arg, entry.examples.get("en", "")),
-    "pos": lambda entry, arg: set(arg.split(",")) <= ({entry.simple_pos} | entry.tags),
-    "antonym": lambda entry, arg: re.search(fix_xifan(arg), entry.antonyms or ""),
-    "synonym": lambda entry, arg: re.search(fix_xifan(arg), entry.synonyms or ""),
-    "components": lambda entry, arg: re.search(fix_xifan(arg), entry.components or ""),
-    "see": lambda entry, arg: re.search(fix_xifan(arg), entry.see_also or ""),
+def compile_regex(pattern: str, flags: int = 0) -> Callable[[str], Any]:
+    return re.compile(pattern, flags).search
+
+def tlh_operator(arg: str) -> QueryPredicate:
+    search = compile_regex(fix_xifan(arg))
+    return lambda entry: search(entry.name)
+
+def notes_operator(arg: str) -> QueryPredicate:
+    search = compile_regex(arg, re.IGNORECASE)
+    return lambda entry: search(entry.notes.get("en", ""))
+
+def ex_operator(arg: str) -> QueryPredicate:
+    search = compile_regex(arg)
+    return lambda entry: search(entry.examples.get("en", ""))
+
+def pos_operator(arg: str) -> QueryPredicate:
+    required = set(arg.split(","))
+    return lambda entry: required <= entry.tags or required <= ({entry.simple_pos} | entry.tags)
+
+def link_field_operator(field: str) -> Callable[[str], QueryPredicate]:
+    def operator(arg: str) -> QueryPredicate:
+        search = compile_regex(fix_xifan(arg))
+        return lambda entry: search(getattr(entry, field) or "")
+    
+    return operator
+
+# Maps an operator name to a function that compiles the operator argument into an entry predicate
+QUERY_OPERATORS: Dict[str, Callable[[str], QueryPredicate]] = {
+    "tlh": tlh_operator,
+    "notes": notes_operator,
+    "ex": ex_operator,
+    "pos": pos_operator,
+    "antonym": link_field_operator("antonyms"),
+    "synonym": link_field_operator("synonyms"),
+    "components": link_field_operator("components"),
+    "see": link_field_operator("see_also"),
 }
 
 def add_operators(language: str):
-    QUERY_OPERATORS[language] = lambda entry, arg: (re.search(arg, entry.definition[language]) or arg in entry.search_tags.get(language, []))
-    QUERY_OPERATORS[language+"notes"] = lambda entry, arg: re.search(arg, entry.notes.get(language, ""))
-    QUERY_OPERATORS[language+"ex"] = lambda entry, arg: re.search(arg, entry.examples.get(language, ""))
+    def definition_operator(arg: str) -> QueryPredicate:
+        search = compile_regex(arg)
+        return lambda entry: (search(entry.definition[language]) or arg in entry.search_tags.get(language, []))
+    
+    def language_notes_operator(arg: str) -> QueryPredicate:
+        search = compile_regex(arg)
+        return lambda entry: search(entry.notes.get(language, ""))
+    
+    def language_ex_operator(arg: str) -> QueryPredicate:
+        search = compile_regex(arg)
+        return lambda entry: search(entry.examples.get(language, ""))
+
+    QUERY_OPERATORS[language] = definition_operator
+    QUERY_OPERATORS[language+"notes"] = language_notes_operator
+    QUERY_OPERATORS[language+"ex"] = language_ex_operator
 
 def init_operators():
     for language in dictionary.locales:
         add_operators(language)
+    
+    compile_query.cache_clear()
+
+class QueryNode(ABC):
+    """
+    A node of a parsed dictionary query.
+    """
+
+    children: List["QueryNode"] = []
+
+    @abstractmethod
+    def label(self) -> str:
+        """
+        Describes the node in query plans.
+        """
+
+    @abstractmethod
+    def expression(self, env: Dict[str, Any]) -> str:
+        """
+        Returns a Python expression that evaluates the node for the variable `entry`.
+        Values referenced by the expression are stored in `env`.
+        """
+
+    def candidates(self) -> Optional[Set[int]]:
+        """
+        Returns the positions of the entries in `entry_list` that can match the node,
+        or None if all entries must be checked.
+        """
+        return None
+
+    @abstractmethod
+    def profiled_predicate(self, children: List["ProfiledNode"]) -> QueryPredicate:
+        """
+        Returns a predicate that evaluates the node using the profiled children instead of the compiled expression.
+        """
+
+def bind(env: Dict[str, Any], value: Any) -> str:
+    name = f"_v{len(env)}"
+    env[name] = value
+    return name
+
+class MatchAll(QueryNode):
+    def label(self) -> str:
+        return "ALL"
+
+    def expression(self, env: Dict[str, Any]) -> str:
+        return "True"
+
+    def profiled_predicate(self, children: List["ProfiledNode"]) -> QueryPredicate:
+        return lambda entry: True
+
+class Not(QueryNode):
+    def __init__(self, child: QueryNode):
+        self.child = child
+        self.children = [child]
+
+    def label(self) -> str:
+        return "NOT"
+
+    def expression(self, env: Dict[str, Any]) -> str:
+        return f"(not {self.child.expression(env)})"
+
+    def profiled_predicate(self, children: List["ProfiledNode"]) -> QueryPredicate:
+        child = children[0]
+        return lambda entry: not child(entry)
+
+class And(QueryNode):
+    def __init__(self, children: List[QueryNode]):
+        self.children = children
+
+    def label(self) -> str:
+        return "AND"
+
+    def expression(self, env: Dict[str, Any]) -> str:
+        return "(" + " and ".join(child.expression(env) for child in self.children) + ")"
+
+    def profiled_predicate(self, children: List["ProfiledNode"]) -> QueryPredicate:
+        return lambda entry: all(child(entry) for child in children)
+
+    def candidates(self) -> Optional[Set[int]]:
+        ans = None
+        for child in self.children:
+            candidates = child.candidates()
+            if candidates is None:
+                continue
+
+            if ans is None:
+                ans = candidates
+
+            else:
+                ans &= candidates
+
+        return ans
+
+class Or(QueryNode):
+    def __init__(self, children: List[QueryNode]):
+        self.children = children
+
+    def label(self) -> str:
+        return "OR"
+
+    def expression(self, env: Dict[str, Any]) -> str:
+        return "(" + " or ".join(child.expression(env) for child in self.children) + ")"
+
+    def profiled_predicate(self, children: List["ProfiledNode"]) -> QueryPredicate:
+        return lambda entry: any(child(entry) for child in children)
+
+    def candidates(self) -> Optional[Set[int]]:
+        ans: Set[int] = set()
+        for child in self.children:
+            candidates = child.candidates()
+            if candidates is None:
+                return None
+
+            ans |= candidates
+
+        return ans
+
+class Term(QueryNode):
+    """
+    An operator term such as `tlh:^qa`. The argument is compiled once when the query is compiled.
+    """
+
+    def __init__(self, op: str, arg: str):
+        self.op = op
+        self.arg = arg
+        self.valid = False
+        # a term whose argument cannot be compiled fails the whole query, see CompiledQuery
+        self.failed = False
+        # why the term matches nothing, shown in query plans
+        self.error: Optional[str] = None
+        if op not in QUERY_OPERATORS:
+            # illegal situation
+            self.predicate: QueryPredicate = lambda entry: False
+            self.error = f"unknown operator {op}"
+            return
+        
+        try:
+            self.predicate = QUERY_OPERATORS[op](arg)
+            self.valid = True
+        
+        except:
+            logger.exception("Error while compiling query term %s:%s", op, arg, exc_info=sys.exc_info())
+            self.predicate = lambda entry: False
+            self.failed = True
+            self.error = str(sys.exc_info()[1])
+
+    def label(self) -> str:
+        return f"{self.op}:{self.arg}"
+
+    def expression(self, env: Dict[str, Any]) -> str:
+        return f"{bind(env, self.predicate)}(entry)"
+
+    def profiled_predicate(self, children: List["ProfiledNode"]) -> QueryPredicate:
+        return self.predicate
+
+    def candidates(self) -> Optional[Set[int]]:
+        if not self.valid:
+            return set()
+
+        if self.op in QUERY_INDEXES:
+            return QUERY_INDEXES[self.op](self.arg)
+
+        return None
+
+class BareWord(QueryNode):
+    """
+    A search term without an operator: matches Klingon names, search tags and definition words.
+    """
+
+    def __init__(self, word: str, language: str):
+        self.word = word
+        self.language = language
+        self.xifan = fix_xifan(word)
+        self.lower = word.lower()
+
+    def matches(self, entry: BoqwizEntry) -> bool:
+        if self.xifan in entry.name:
+            return True
+        
+        lower = self.lower
+        if any(tag.lower().startswith(lower) for tag in entry.search_tags.get(self.language, [])):
+            return True
+        
+        if any(word.startswith(lower) for word in entry.definition.get(self.language, "").lower().split()):
+            return True
+        
+        return False
+
+    def label(self) -> str:
+        return self.word
+
+    def expression(self, env: Dict[str, Any]) -> str:
+        return f"{bind(env, self.matches)}(entry)"
+
+    def profiled_predicate(self, children: List["ProfiledNode"]) -> QueryPredicate:
+        return self.matches
+
+    def candidates(self) -> Optional[Set[int]]:
+        if self.language not in prefix_indexes:
+            return None
+
+        names = name_index.lookup(self.xifan)
+        if names is None:
+            return None
+
+        return names | prefix_indexes[self.language].lookup(self.lower)
+
+def iter_terms(node: QueryNode) -> Iterator[Term]:
+    if isinstance(node, Term):
+        yield node
+
+    for child in node.children:
+        yield from iter_terms(child)
+
+class CompiledQuery:
+    """
+    A parsed dictionary query together with a single predicate function that evaluates it.
+
+    A query with a term that could not be compiled (e.g. an invalid regular expression) matches nothing, even if the
+    term is negated; the errors of such terms are in `errors`.
+    """
+
+    def __init__(self, tree: QueryNode, errors: List[str] = []):
+        self.tree = tree
+        self.errors = errors + [f"{term.label()}: {term.error}" for term in iter_terms(tree) if term.failed]
+        if self.errors:
+            self.predicate: QueryPredicate = lambda entry: False
+            return
+
+        env: Dict[str, Any] = {}
+        self.predicate = eval(f"lambda entry: bool({tree.expression(env)})", env)
+
+    def __call__(self, entry: BoqwizEntry) -> bool:
+        return self.predicate(entry)
+
+    def candidates(self) -> Optional[Set[int]]:
+        """
+        Returns the positions of the entries that can match the query, or None if the indexes cannot narrow it down.
+        """
+        if self.errors:
+            return set()
+
+        return self.tree.candidates()
+
+    def candidate_entries(self) -> List[BoqwizEntry]:
+        """
+        Returns the entries that can match the query in dictionary order, using the search indexes.
+        """
+        candidates = self.candidates()
+        if candidates is None:
+            return entry_list
+
+        return [entry_list[position] for position in sorted(candidates)]
+
+class ProfiledNode:
+    """
+    Evaluates a query node and its children one by one, counting the evaluations, matches, time and errors of each node.
+    Much slower than CompiledQuery, so only used to explain queries.
+    """
+
+    def __init__(self, node: QueryNode):
+        self.node = node
+        self.children = [ProfiledNode(child) for child in node.children]
+        self.predicate = node.profiled_predicate(self.children)
+        self.evaluations = 0
+        self.matches = 0
+        self.errors = 0
+        self.seconds = 0.0
+        start = time.perf_counter()
+        self.candidates = node.candidates()
+        self.index_seconds = time.perf_counter() - start
+
+    def __call__(self, entry: BoqwizEntry) -> bool:
+        self.evaluations += 1
+        start = time.perf_counter()
+        try:
+            ans = bool(self.predicate(entry))
+        
+        except:
+            # an error is counted in the node where it was raised and fails the whole entry like in CompiledQuery
+            if not self.children:
+                self.errors += 1
+            
+            raise
+        
+        finally:
+            self.seconds += time.perf_counter() - start
+        
+        if ans:
+            self.matches += 1
+        
+        return ans
+
+    def plan(self) -> Dict[str, Any]:
+        ans = {
+            "node": self.node.label(),
+            "evaluations": self.evaluations,
+            "matches": self.matches,
+            "time_ms": self.seconds * 1000,
+            "errors": self.errors,
+            "index": self.candidates is not None,
+            "candidates": None if self.candidates is None else len(self.candidates),
+            "index_time_ms": self.index_seconds * 1000,
+        }
+        if isinstance(self.node, Term) and self.node.error:
+            ans["error"] = self.node.error
+        
+        if self.children:
+            ans["children"] = [child.plan() for child in self.children]
+        
+        return ans
+
+# the maximum number of nested parentheses and NOTs in a query; deeper queries could not be compiled to one expression
+MAX_QUERY_DEPTH = 32
+
+class QueryCompiler:
+    def __init__(self, language: str):
+        self.language = language
+        self.depth = 0
+
+    def parse_or(self, parts: List[str]) -> QueryNode:
+        a = self.parse_and(parts)
+        while parts and parts[0] in {"OR", "TAI"}:
+            parts.pop(0)
+            b = self.parse_and(parts)
+            a = self.create_or(a, b)
+        
+        return a
+
+    def parse_and(self, parts: List[str]) -> QueryNode:
+        a = self.parse_term(parts)
+        while parts and parts[0] not in {")", "OR", "TAI"}:
+            if parts[0] in {"AND", "JA"}:
+                parts.pop(0)
+            
+            b = self.parse_term(parts)
+            a = self.create_and(a, b)
+        
+        return a
+
+    def create_or(self, a: QueryNode, b: QueryNode) -> QueryNode:
+        return Or((a.children if isinstance(a, Or) else [a]) + [b])
+
+    def create_and(self, a: QueryNode, b: QueryNode) -> QueryNode:
+        return And((a.children if isinstance(a, And) else [a]) + [b])
+
+    def parse_term(self, parts: List[str]) -> QueryNode:
+        if not parts:
+            return MatchAll()
+        
+        part = parts.pop(0)
+        if part in {"(", "NOT", "EI"}:
+            self.depth += 1
+            if self.depth > MAX_QUERY_DEPTH:
+                raise ValueError(f"the query is nested more than {MAX_QUERY_DEPTH} levels deep")
+        
+        if part == "(":
+            r = self.parse_or(parts)
+            if parts: parts.pop(0) # )
+            self.depth -= 1
+            return r
+        
+        if part in {"NOT", "EI"}:
+            r = Not(self.parse_term(parts))
+            self.depth -= 1
+            return r
+        
+        if ":" in part:
+            op = part[:part.index(":")]
+            arg = part[part.index(":")+1:]
+            return Term(op, arg)
+        
+        else:
+            return BareWord(part, self.language)
+
+def tokenize_query(query: str) -> List[str]:
+    parts = [""]
+    quote = False
+    for i in range(len(query)):
+        if not quote and query[i] == " ":
+            parts += [""]
+            continue
+    
+        if not quote and query[i] in "()":
+            parts += [query[i], ""]
+            continue
+
+        if query[i] == "\"":
+            quote = not quote
+            continue
+        
+        parts[-1] += query[i]
+    
+    return parts
+
+@functools.lru_cache(maxsize=1024)
+def compile_query(query: str, language: str) -> CompiledQuery:
+    """
+    Parses and compiles a dsl query. Compiled queries are cached by (query, language).
+    A query that cannot be compiled fails like a query with an invalid term.
+    """
+    try:
+        return CompiledQuery(QueryCompiler(language).parse_or(tokenize_query(query)))
+    
+    except (ValueError, RecursionError, SyntaxError, MemoryError):
+        logger.exception("Error while compiling query %s", query, exc_info=sys.exc_info())
+        return CompiledQuery(MatchAll(), [str(sys.exc_info()[1])])
 
 init_operators()
 
 def get_wiki_name(name: str) -> str:
     name = name.replace(" ", "")
     ans = ""
-    for letter in yajwiz.split_to_letters(name):
+    for letter in analyzer.split_to_letters(name):
         if letter == "q":
             ans += "k"
         
@@ -63,13 +661,25 @@ def get_wiki_name(name: str) -> str:
     
     return ans.capitalize()
 
+class QueryTimeout(Exception):
+    """
+    Raised when a query exceeds its CPU time limit or is cancelled.
+    """
+
+# how many entries are scanned between checking the time limit and cancellation
+CHECK_INTERVAL = 256
+
 class DictionaryQuery:
-    def __init__(self, query: str, language: str, link_format: Literal["html", "latex"] = "html"):
+    def __init__(self, query: str, language: str, link_format: Literal["html", "latex"] = "html", cpu_limit: Optional[float] = None, cancel: Optional[threading.Event] = None):
         self.query = query
         self.language = language
         self.locale_strings = locales.locale_map[language]
         self.link_format = link_format
         self.link_renderer = LinkRenderer(self) if link_format == "html" else LinkRendererLatex(self)
+        self.cpu_limit = cpu_limit
+        self.cpu_used = 0.0
+        self.cpu_mark = time.thread_time()
+        self.cancel = cancel
     
     def execute_query(self):
         """
@@ -81,38 +691,114 @@ class DictionaryQuery:
         if not self.query:
             return ""
         
-        query = self.query
-        query = re.sub(r"[’`‘]", "'", query)
-        query = re.sub(r"[”“]", "\"", query)
-        query = re.sub(r"\s{2,}", " ", query)
-        query = query.strip()
+        return list(self.iter_results())
 
-        parts = []
+    def iter_results(self, offset: int = 0, limit: Optional[int] = None, rank: bool = False) -> Iterator[dict]:
+        """
+        Yields the rendered results lazily. Only the results between offset and offset+limit are rendered.
+        If rank is set, the results are ordered by relevance.
+        """
+        entries = self.ranked_entries(None if limit is None else offset+limit) if rank else self.iter_entries()
+        for entry in itertools.islice(entries, offset, None if limit is None else offset+limit):
+            yield self.render_entry(entry)
+
+    def iter_entries(self) -> Iterator[BoqwizEntry]:
+        if not self.query:
+            return
         
-        analyses = yajwiz.analyze(fix_xifan(query))
-        if analyses:
-            parts += self.fix_analysis_parts(analyses)
+        self.start_limits()
+        query = normalize_query(self.query)
+        parts = self.analysis_parts(query)
+        for part in parts:
+            yield dictionary.entries[part]
         
-        if ":" not in query:
-            words = query.split(" ")
-            analyses = []
-            for word in words:
-                analyses += yajwiz.analyze(fix_xifan(word))
+        yield from self.iter_dsl_query(query, set(parts))
+
+    def ranked_entries(self, k: Optional[int] = None) -> Iterator[BoqwizEntry]:
+        """
+        Yields the k most relevant results (or all of them if k is None), the most relevant first.
+        The parts found by analyzing the query come first in their own order, the rest are ordered by
+        relevance, and results with equal relevance are in the same order as in iter_entries.
+        """
+        if not self.query:
+            return
+        
+        self.start_limits()
+        query = normalize_query(self.query)
+        parts = self.analysis_parts(query)
+        included = {part: len(parts) - i for i, part in enumerate(parts)}
+        words = relevance_words(query)
+        def relevance(entry: BoqwizEntry) -> Tuple[int, bool, bool, int, int]:
+            return (included.get(entry.id, 0),) + self.relevance(entry, words)
+        
+        entries = itertools.chain((dictionary.entries[part] for part in parts), self.iter_dsl_query(query, set(parts)))
+        if k is None:
+            yield from sorted(entries, key=relevance, reverse=True)
+        
+        else:
+            # nlargest keeps only k entries in a heap
+            yield from heapq.nlargest(k, entries, key=relevance)
+
+    def relevance(self, entry: BoqwizEntry, words: List[str]) -> Tuple[bool, bool, int, int]:
+        """
+        Returns a sort key for how well the entry matches the bare words of a query: exact name match, name prefix match,
+        definition match (2 for an exact match of the definition or a search tag, 1 for a definition word prefix) and
+        the number of derived entries.
+        """
+        exact = prefix = False
+        definition_match = 0
+        definition = entry.definition.get(self.language, "").lower()
+        search_tags = entry.search_tags.get(self.language, [])
+        for word in words:
+            xifan = fix_xifan(word)
+            lower = word.lower()
+            exact = exact or entry.name == xifan
+            prefix = prefix or entry.name.startswith(xifan)
+            if definition == lower or any(tag.lower() == lower for tag in search_tags):
+                definition_match = 2
             
-            if analyses:
-                parts += self.fix_analysis_parts(analyses)
+            elif not definition_match and any(w.startswith(lower) for w in definition.split()):
+                definition_match = 1
         
-        included = set()
-        ans = []
-        for part in parts:
-            if part not in included:
-                included.add(part)
+        return exact, prefix, definition_match, entry_store.derived_count(entry.id)
 
-                ans.append(self.render_entry(dictionary.entries[part]))
+    def take(self, iterator: Iterator[Any], n: int) -> List[Any]:
+        """
+        Takes at most n items from an iterator that executes this query, such as iter_results.
+        The CPU time limit is accounted for correctly even if the items are taken in different threads.
+        """
+        self.start_limits()
+        try:
+            return list(itertools.islice(iterator, n))
         
-        ans += self.dsl_query(query, included)
+        finally:
+            self.cpu_used += time.thread_time() - self.cpu_mark
+            self.cpu_mark = time.thread_time()
 
-        return ans
+    def start_limits(self):
+        self.cpu_mark = time.thread_time()
+
+    def analysis_parts(self, query: str) -> List[str]:
+        """
+        Returns the ids of the entries found by analyzing the query as a Klingon word and word by word.
+        """
+        parts = []
+        
+        with metrics.stage("analyze"):
+            analyses = memo.analyze(fix_xifan(query), analyzer)
+            if analyses:
+                parts += self.fix_analysis_parts(analyses)
+            
+            if ":" not in query:
+                words = query.split(" ")
+                analyses = []
+                for word in words:
+                    analyses += memo.analyze(fix_xifan(word), analyzer)
+                
+                if analyses:
+                    parts += self.fix_analysis_parts(analyses)
+        
+        return list(dict.fromkeys(parts))
 
     def fix_analysis_parts(self, analyses: List[yajwiz.analyzer.Analysis]):
         parts = []
@@ -125,112 +811,124 @@ class DictionaryQuery:
         parts.sort(key=lambda p: names.index(p[:p.index(":")]))
         return parts
 
-    def dsl_query(self, query: str, included: Set[str]):
-        parts = [""]
-        quote = False
-        for i in range(len(query)):
-            if not quote and query[i] == " ":
-                parts += [""]
-                continue
+    def iter_dsl_query(self, query: str, included: Set[str]) -> Iterator[BoqwizEntry]:
+        query_function = compile_query(query, self.language)
+        scanned = matched = errors = 0
+        # the time spent by the consumer between the results is not counted
+        elapsed = 0.0
+        start = time.perf_counter()
+        try:
+            for scanned, entry in enumerate(query_function.candidate_entries(), 1):
+                if scanned % CHECK_INTERVAL == 1:
+                    self.check_limits()
+                
+                try:
+                    f = query_function(entry)
+                
+                except:
+                    # logging every failing entry would be slower than the query itself
+                    if not errors:
+                        logger.exception("Error during executing query %s", query, exc_info=sys.exc_info())
+                    
+                    errors += 1
+                    f = False
+                
+                if entry.id not in included and f:
+                    matched += 1
+                    elapsed += time.perf_counter() - start
+                    yield entry
+                    start = time.perf_counter()
         
-            if not quote and query[i] in "()":
-                parts += [query[i], ""]
-                continue
+        finally:
+            if errors > 1:
+                logger.warning("Query %s failed for %d entries", query, errors)
+            
+            if metrics.ENABLED:
+                metrics.STAGE_SECONDS.observe(elapsed + time.perf_counter() - start, "scan")
+                metrics.ENTRIES_SCANNED.inc(scanned)
+                metrics.ENTRIES_MATCHED.inc(matched)
 
-            if query[i] == "\"":
-                quote = not quote
-                continue
+    def explain(self) -> Dict[str, Any]:
+        """
+        Executes the query with every node of the query tree profiled and returns the query plan instead of the results.
+        """
+        self.start_limits()
+        query = normalize_query(self.query)
+        start = time.perf_counter()
+        parts = self.analysis_parts(query)
+        analysis_seconds = time.perf_counter() - start
+        included = set(parts)
+        compiled = compile_query(query, self.language)
+        root = ProfiledNode(compiled.tree)
+        # a query with failed terms matches nothing and is not scanned
+        candidates = set() if compiled.errors else root.candidates
+        entries = entry_list if candidates is None else [entry_list[position] for position in sorted(candidates)]
+        scanned = matched = errors = 0
+        start = time.perf_counter()
+        for scanned, entry in enumerate(entries, 1):
+            if scanned % CHECK_INTERVAL == 1:
+                self.check_limits()
             
-            parts[-1] += query[i]
-        
-        ans = []
-        query_function = self.parse_or(parts)
-        for entry_id, entry in dictionary.entries.items():
             try:
-                f = query_function(entry)
+                f = root(entry)
             
             except:
-                logger.exception("Error during executing query", exc_info=sys.exc_info())
+                errors += 1
                 f = False
             
-            if entry_id not in included and f:
-                ans.append(self.render_entry(entry))
+            if entry.id not in included and f:
+                matched += 1
         
-        return ans
+        return {
+            "query": query,
+            "analysis": {"parts": parts, "time_ms": analysis_seconds * 1000},
+            "scan": {
+                "index": candidates is not None,
+                "scanned": scanned,
+                "matched": matched,
+                "errors": errors,
+                "time_ms": (time.perf_counter() - start) * 1000,
+            },
+            "tree": root.plan(),
+            "errors": compiled.errors,
+        }
 
-    def parse_or(self, parts: List[str]):
-        a = self.parse_and(parts)
-        while parts and parts[0] in {"OR", "TAI"}:
-            parts.pop(0)
-            b = self.parse_and(parts)
-            a = self.create_or(a, b)
+    def check_limits(self):
+        if self.cancel is not None and self.cancel.is_set():
+            raise QueryTimeout("The query was cancelled")
         
-        return a
+        if self.cpu_limit is not None and self.cpu_used + time.thread_time() - self.cpu_mark > self.cpu_limit:
+            raise QueryTimeout(f"The query exceeded its time limit of {self.cpu_limit} seconds")
 
-    def parse_and(self, parts: List[str]):
-        a = self.parse_term(parts)
-        while parts and parts[0] not in {")", "OR", "TAI"}:
-            if parts[0] in {"AND", "JA"}:
-                parts.pop(0)
+    def render_entry(self, entry: BoqwizEntry, include_derivs: bool = True) -> dict:
+        """
+        Renders the entry or returns it from the render cache. The returned dict is shared and must not be modified.
+        """
+        render_cache.check_version(dictionary.version)
+        key = (entry.id, self.language, self.link_format, include_derivs)
+        ans = render_cache.get(key)
+        if ans is None:
+            if prerendered and prerendered.version == dictionary.version:
+                ans = prerendered.get(*key)
             
-            b = self.parse_term(parts)
-            a = self.create_and(a, b)
-        
-        return a
-
-    def create_or(self, a, b):
-        return lambda *args: (a(*args) or b(*args))
-
-    def create_and(self, a, b):
-        return lambda *args: (a(*args) and b(*args))
-
-    def parse_term(self, parts: List[str]):
-        if not parts:
-            return lambda *args: True
-        
-        part = parts.pop(0)
-        if part == "(":
-            r = self.parse_or(parts)
-            if parts: parts.pop(0) # )
-            return r
-        
-        if part in {"NOT", "EI"}:
-            r = self.parse_term(parts)
-            return lambda *args: not r(*args)
-        
-        if ":" in part:
-            op = part[:part.index(":")]
-            arg = part[part.index(":")+1:]
-            if op in QUERY_OPERATORS:
-                return lambda entry: QUERY_OPERATORS[op](entry, arg)
+            if ans is None:
+                # derived entries are rendered inside their parent and included in its time
+                with metrics.stage("render") if include_derivs else metrics.NULL_TIMER:
+                    ans = self._render_entry(entry, include_derivs)
             
-            else:
-                # illegal situation
-                return lambda entry: False
+            render_cache.put(key, ans)
         
-        else:
-            def func(entry: BoqwizEntry):
-                if fix_xifan(part) in entry.name:
-                    return True
-                
-                if any_word_starts_with(part, entry.search_tags.get(self.language, [])):
-                    return True
-                
-                if any_word_starts_with(part, entry.definition.get(self.language, "").lower().split()):
-                    return True
-                
-                return False
-            
-            return func
+        return ans
 
-    def render_entry(self, entry: BoqwizEntry, include_derivs: bool = True) -> dict:
+    def _render_entry(self, entry: BoqwizEntry, include_derivs: bool) -> dict:
         ans = {
+            "id": entry.id,
             "name": entry.name,
             "url_name": entry.name.replace(" ", "+"),
             "wiki_name": get_wiki_name(entry.name),
-            "graphemes": yajwiz.split_to_letters(entry.name),
-            "syllables": yajwiz.split_to_syllables(entry.name),
-            "morphemes": list(map(list, yajwiz.split_to_morphemes(entry.name))),
+            "graphemes": analyzer.split_to_letters(entry.name),
+            "syllables": analyzer.split_to_syllables(entry.name),
+            "morphemes": list(map(list, analyzer.split_to_morphemes(entry.name))),
             "pos": self.locale_strings["unknown"],
             "simple_pos": "affix" if entry.name.startswith("-") or entry.name.endswith("-") or entry.name == "0" else entry.simple_pos,
             "boqwi_tags": list(entry.tags),
@@ -339,7 +1037,7 @@ class DictionaryQuery:
         
         if include_derivs:
             derived = []
-            for entry2 in derived_index[entry.id]:
+            for entry2 in derived_entries(entry):
                 derived.append(self.render_entry(entry2, include_derivs=False))
             
             if derived:
@@ -358,25 +1056,29 @@ class DictionaryQuery:
             return d[self.language]
 
     def fix_links(self, text: str) -> str:
-        ans = ""
-        while "{" in text:
-            i = text.index("{")
-            ans += text[:i]
-            text = text[i+1:]
-            i = text.index("}")
-            link = text[:i]
-            ans += self.link_renderer.fix_link(link)
-            text = text[i+1:]
-        
-        ans += text
-        return ans.replace("\n", "<br>")
+        tokens = tokenize_links(text)
+        ans = [tokens[0]]
+        for i in range(1, len(tokens), 2):
+            ans.append(self.link_renderer.render(tokens[i]))
+            ans.append(tokens[i+1])
+        
+        return "".join(ans).replace("\n", "<br>")
 
 class LinkRenderer:
     def __init__(self, query: DictionaryQuery):
         self.query = query
+        # rendered links by their source text
+        self.rendered: Dict[str, str] = {}
+    
+    def render(self, link: "Link") -> str:
+        ans = self.rendered.get(link.raw)
+        if ans is None:
+            ans = self.rendered[link.raw] = self.fix_link(link)
+        
+        return ans
     
-    def fix_link(self, link: str) -> str:
-        link_text, link_type, tags, parts1, parts2 = parse_link(link)
+    def fix_link(self, link: "Link") -> str:
+        link_text, link_type, tags, parts1, parts2 = link.text, link.type, link.tags, link.parts1, link.parts2
         
         if "nolink" in tags:
             style = "affix" if "-" in link_text else link_type if link_type else "sen"
@@ -422,8 +1124,8 @@ class LinkRenderer:
         return f"<a href=\"?q=tlh:&quot;^{link_text.replace(' ', '+')}$&quot;{pos}{hom_pos}\" class=\"pos-{style}\"{defn}>{hyp}<span okrand>{link_text}</span>{hom}</a>"
 
 class LinkRendererLatex(LinkRenderer):
-    def fix_link(self, link: str) -> str:
-        link_text, link_type, tags, parts1, parts2 = parse_link(link)
+    def fix_link(self, link: "Link") -> str:
+        link_text, link_type, tags, parts1, parts2 = link.text, link.type, link.tags, link.parts1, link.parts2
 
         if link_type not in ["src", "url"]:
             link_text = " ".join("\\mbox{" + word + "}" for word in link_text.split(" "))
@@ -466,45 +1168,233 @@ class LinkRendererLatex(LinkRenderer):
         
         return "\\klingonref[%s]{%s\\klingontext{%s}%s}" % (style, hyp, link_text, hom)
 
-def dictionary_query(query: str, lang: str, link_format: Literal["html", "latex"]):
-    return DictionaryQuery(query=query, language=lang, link_format=link_format).execute_query()
+def normalize_query(query: str) -> str:
+    query = re.sub(r"[’`‘]", "'", query)
+    query = re.sub(r"[”“]", "\"", query)
+    query = re.sub(r"\s{2,}", " ", query)
+    return query.strip()
+
+def relevance_words(query: str) -> List[str]:
+    """
+    Returns the bare words of a dsl query, ie. the words without an operator.
+    """
+    return [part for part in tokenize_query(query) if part and ":" not in part and part not in {"(", ")", "OR", "TAI", "AND", "JA", "NOT", "EI"}]
+
+def dictionary_query(query: str, lang: str, link_format: Literal["html", "latex"], cpu_limit: Optional[float] = None, cancel: Optional[threading.Event] = None, offset: int = 0, limit: Optional[int] = None, rank: bool = False):
+    if not query:
+        return ""
+    
+    return list(DictionaryQuery(query=query, language=lang, link_format=link_format, cpu_limit=cpu_limit, cancel=cancel).iter_results(offset, limit, rank))
+
+def explain_query(query: str, lang: str, cpu_limit: Optional[float] = None, cancel: Optional[threading.Event] = None) -> Dict[str, Any]:
+    return DictionaryQuery(query=query, language=lang, cpu_limit=cpu_limit, cancel=cancel).explain()
+
+def batch_query(queries: List[str], lang: str, link_format: Literal["html", "latex"], cpu_limit: Optional[float] = None, cancel: Optional[threading.Event] = None) -> Dict[str, Any]:
+    """
+    Executes many queries with one pass over the dictionary. Returns the results by query,
+    each result being the same as that of dictionary_query. Each entry is rendered only once.
+    """
+    runner = DictionaryQuery("", lang, link_format, cpu_limit=cpu_limit, cancel=cancel)
+    runner.start_limits()
+    rendered: Dict[str, dict] = {}
+    def render(entry: BoqwizEntry) -> dict:
+        if entry.id not in rendered:
+            rendered[entry.id] = runner.render_entry(entry)
+        
+        return rendered[entry.id]
+
+    results: Dict[str, Any] = {}
+    plans = []
+    # the number of failing entries by query
+    errors: Dict[CompiledQuery, int] = {}
+    for query in dict.fromkeys(queries):
+        if not query:
+            results[query] = ""
+            continue
+        
+        normalized = normalize_query(query)
+        parts = runner.analysis_parts(normalized)
+        results[query] = [render(dictionary.entries[part]) for part in parts]
+        compiled = compile_query(normalized, lang)
+        plans.append((results[query], compiled, set(parts), compiled.candidates()))
+    
+    if any(candidates is None for _, _, _, candidates in plans):
+        positions: Collection[int] = range(len(entry_list))
+    
+    else:
+        positions = sorted(set().union(*[candidates for _, _, _, candidates in plans]))
+    
+    for i, position in enumerate(positions):
+        if i % CHECK_INTERVAL == 0:
+            runner.check_limits()
+        
+        entry = entry_list[position]
+        for result, query_function, included, candidates in plans:
+            if candidates is not None and position not in candidates:
+                continue
+            
+            try:
+                f = query_function(entry)
+            
+            except:
+                if query_function not in errors:
+                    logger.exception("Error during executing query", exc_info=sys.exc_info())
+                
+                errors[query_function] = errors.get(query_function, 0) + 1
+                f = False
+            
+            if entry.id not in included and f:
+                result.append(render(entry))
+    
+    for count in errors.values():
+        if count > 1:
+            logger.warning("A query of the batch failed for %d entries", count)
+    
+    return results
+
+def build_prerendered(path: str):
+    """
+    Renders every entry for every locale and link format and writes them to a prerender file.
+    """
+    queries: Dict[Any, DictionaryQuery] = {}
+    failures: DefaultDict[Any, int] = DefaultDict(int)
+    def render(entry_id: str, language: str, link_format: str, include_derivs: bool) -> Optional[dict]:
+        if (language, link_format) not in queries:
+            queries[language, link_format] = DictionaryQuery("", language, link_format) # type: ignore
+        
+        try:
+            return queries[language, link_format]._render_entry(dictionary.entries[entry_id], include_derivs)
+        
+        except:
+            # entries that cannot be rendered are left out and rendered normally when requested
+            if not failures[language, link_format]:
+                logger.exception("Error while prerendering %s (%s, %s)", entry_id, language, link_format, exc_info=sys.exc_info())
+            
+            failures[language, link_format] += 1
+            return None
 
-def any_word_starts_with(word: str, words: List[str]):
-    return any([part.lower().startswith(word.lower()) for part in words])
+    logger.info("Prerendering dictionary version %s to %s", dictionary.version, path)
+    write_prerendered(path, dictionary.version, list(dictionary.entries), list(locales.locale_map), render)
+    for (language, link_format), count in failures.items():
+        logger.warning("Could not prerender %d entries (%s, %s)", count, language, link_format)
+
+def load_prerendered(path: str, build: bool = True):
+    """
+    Serves rendered entries from a prerender file. The file is (re)built if it is missing or outdated and `build` is set.
+    """
+    global prerendered
+    table = None
+    try:
+        table = PrerenderedEntries(path)
+    
+    except (OSError, ValueError):
+        logger.info("Could not read prerender file %s", path)
+    
+    if (table is None or table.version != dictionary.version) and build:
+        if table:
+            table.close()
+        
+        build_prerendered(path)
+        table = PrerenderedEntries(path)
+    
+    if table and table.version != dictionary.version:
+        logger.warning("Prerender file %s is for dictionary version %s, not %s", path, table.version, dictionary.version)
+    
+    prerendered = table
 
 def get_id(link_text: str, link_type: str, tags: Collection[str]) -> str:
     homonyms = [tag.strip("h") for tag in tags if re.fullmatch(r"\d+h?", tag)]
     return link_text + ":" + ":".join([link_type] + homonyms)
 
-def get_links(text: str) -> List[str]:
-    ids = []
-    while "{" in text:
-        i = text.index("{")
-        text = text[i+1:]
-        i = text.index("}")
-        link_text, link_type, tags, _, _ = parse_link(text[:i])
-        ids.append(get_id(link_text, link_type, tags))
-        text = text[i+1:]
+class Link(NamedTuple):
+    """
+    A link of the form {text:type:tags@@...}.
+    """
+
+    raw: str
+    text: str
+    type: str
+    tags: List[str]
+    parts1: List[str]
+    parts2: List[str]
+    id: str
+
+# texts that contain links split to literal strings (at even indices) and links (at odd indices)
+link_tokens: Dict[str, Tuple[Any, ...]] = {}
+# the same links appear in many texts and are shared
+parsed_links: Dict[str, "Link"] = {}
+
+def tokenize_links(text: str) -> Tuple[Any, ...]:
+    """
+    Splits the text to literal strings and links. Each text is parsed only once.
+    """
+    if "{" not in text:
+        return (text,)
+    
+    tokens = link_tokens.get(text)
+    if tokens is None:
+        parts: List[Any] = []
+        rest = text
+        while "{" in rest:
+            i = rest.index("{")
+            parts.append(rest[:i])
+            rest = rest[i+1:]
+            i = rest.index("}")
+            link = rest[:i]
+            if link not in parsed_links:
+                parsed_links[link] = parse_link(link)
+            
+            parts.append(parsed_links[link])
+            rest = rest[i+1:]
+        
+        parts.append(rest)
+        tokens = link_tokens[text] = tuple(parts)
     
-    return ids
+    return tokens
+
+def get_links(text: str) -> List[str]:
+    return [link.id for link in tokenize_links(text)[1::2]]
 
-def parse_link(link: str):
+def parse_link(link: str) -> Link:
     parts1 = link.split("@@")
     parts2 = parts1[0].split(":")
     link_text = parts2[0]
     link_type = parts2[1] if len(parts2) > 1 else ""
     tags = parts2[2].split(",") if len(parts2) > 2 else []
-    return link_text, link_type, tags, parts1, parts2
+    return Link(link, link_text, link_type, tags, parts1, parts2, get_id(link_text, link_type, tags))
+
+# fix_xifan in one pass: the alternatives are tried in the same order and consume the same characters
+# as the original sequence of substitutions i→I, d→D, s→S, ([^cgl]|[^t]l|^)h→\1H, x→tlh, f→ng, c(?!h)→ch, (?<!n)g(?!h)→gh
+XIFAN_PATTERN = re.compile(r"([^cgl])h|([^t])lh|^h|[idsxf]|c(?!h)|(?<!n)g(?!h)")
+XIFAN_LETTERS = {"i": "I", "d": "D", "s": "S", "x": "tlh", "f": "ng", "c": "ch", "g": "gh", "h": "H"}
+
+def xifan_replacement(match: "re.Match[str]") -> str:
+    if match.group(1) is not None:
+        letter = match.group(1)
+        return (letter if letter == "h" else XIFAN_LETTERS.get(letter, letter)) + "H"
+    
+    if match.group(2) is not None:
+        letter = match.group(2)
+        if letter == "g" and match.start() > 0 and match.string[match.start()-1] == "n":
+            return "glH"
+        
+        return (letter if letter == "h" else XIFAN_LETTERS.get(letter, letter)) + "lH"
+    
+    return XIFAN_LETTERS[match.group()]
 
+@functools.lru_cache(maxsize=4096)
 def fix_xifan(query: str) -> str:
-    query = re.sub(r"i", "I", query)
-    query = re.sub(r"d", "D", query)
-    query = re.sub(r"s", "S", query)
-    query = re.sub(r"([^cgl]|[^t]l|^)h", r"\1H", query)
-    query = re.sub(r"x", "tlh", query)
-    query = re.sub(r"f", "ng", query)
-    query = re.sub(r"c(?!h)", "ch", query)
-    query = re.sub(r"(?<!n)g(?!h)", "gh", query)
-    return query
-
-make_derived_index()
\ No newline at end of file
+    """
+    Converts the xifan transliteration (and lowercase letters) to the standard Klingon orthography.
+    """
+    return XIFAN_PATTERN.sub(xifan_replacement, query)
+
+def fix_xifan_all(texts: Iterable[str]) -> List[str]:
+    """
+    Converts many texts with fix_xifan, converting each distinct text only once.
+    """
+    texts = list(texts)
+    converted = {text: XIFAN_PATTERN.sub(xifan_replacement, text) for text in set(texts)}
+    return [converted[text] for text in texts]
+
+init_indexes()
\ No newline at end of file
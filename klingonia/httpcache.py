@@ -0,0 +1,148 @@
+"""
+Caching of dictionary responses and static files.
+
+The responses of the dictionary routes depend only on the query parameters and the dictionary version, so their
+bodies are cached together with their compressed variants. Responses carry an ETag (a hash of the body), Last-Modified
+(when the body was cached) and Cache-Control, and conditional requests are answered with 304 Not Modified.
+Static files are served from memory in the same way.
+"""
+
+import asyncio
+from email.utils import formatdate, parsedate_to_datetime
+import functools
+import hashlib
+import mimetypes
+import os
+import time
+from typing import Awaitable, Callable, Dict, Hashable, NamedTuple, Optional, Tuple
+
+from aiohttp import web
+
+from . import compression
+from .cache import LRUCache
+
+RESPONSE_CACHE_SIZE = int(os.environ.get("KLINGONIA_RESPONSE_CACHE_SIZE", 64 * 1024 * 1024))
+
+# max-age of cached responses in seconds; new dictionary versions are loaded while the server is running
+CACHE_MAX_AGE = int(os.environ.get("KLINGONIA_CACHE_MAX_AGE", 600))
+
+# max-age of static files in seconds
+STATIC_MAX_AGE = int(os.environ.get("KLINGONIA_STATIC_MAX_AGE", 3600))
+
+# query parameters that make responses uncacheable
+UNCACHED_PARAMETERS = {"stream", "explain"}
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    # compressed bodies by content encoding
+    variants: Dict[str, bytes]
+    content_type: str
+    charset: Optional[str]
+    etag: str
+    last_modified: float
+
+response_cache = LRUCache(RESPONSE_CACHE_SIZE)
+
+def cache_key(request: web.Request, normalize_query: Callable[[str], str]) -> Optional[Hashable]:
+    """
+    Returns the key of the response, or None if it must not be cached. The query is normalized like dictionary queries.
+    """
+    if request.method != "GET" or any(request.query.get(name, "") for name in UNCACHED_PARAMETERS):
+        return None
+
+    parameters = tuple(sorted((name, normalize_query(value) if name == "q" else value) for name, value in request.query.items()))
+    return (request.match_info.route.name or request.match_info.route.handler.__name__, request.match_info.get("lang", ""), parameters)
+
+def not_modified(request: web.Request, cached: CachedResponse) -> bool:
+    if "If-None-Match" in request.headers:
+        tags = {tag.strip()[2:] if tag.strip().startswith("W/") else tag.strip() for tag in request.headers["If-None-Match"].split(",")}
+        return "*" in tags or cached.etag in tags or any(variant_etag(cached.etag, encoding) in tags for encoding in cached.variants)
+
+    if "If-Modified-Since" in request.headers:
+        try:
+            return int(cached.last_modified) <= parsedate_to_datetime(request.headers["If-Modified-Since"]).timestamp()
+
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+def variant_etag(etag: str, encoding: str) -> str:
+    # a compressed body is a different representation and needs its own strong validator
+    return etag[:-1] + "-" + encoding + "\""
+
+def make_cached_response(body: bytes, variants: Dict[str, bytes], content_type: str, charset: Optional[str], last_modified: float) -> CachedResponse:
+    etag = "\"" + hashlib.sha256(body).hexdigest()[:32] + "\""
+    return CachedResponse(body, variants, content_type, charset, etag, last_modified)
+
+def make_response(request: web.Request, cached: CachedResponse, max_age: int = CACHE_MAX_AGE) -> web.Response:
+    encoding = compression.accepted_encoding(request, cached.variants)
+    headers = {
+        "ETag": variant_etag(cached.etag, encoding) if encoding else cached.etag,
+        "Last-Modified": formatdate(cached.last_modified, usegmt=True),
+        "Cache-Control": f"public, max-age={max_age}",
+        "Vary": "Accept-Encoding",
+    }
+    if not_modified(request, cached):
+        return web.Response(status=304, headers=headers)
+
+    if encoding:
+        headers["Content-Encoding"] = encoding
+
+    return web.Response(body=cached.variants[encoding] if encoding else cached.body, content_type=cached.content_type, charset=cached.charset, headers=headers)
+
+async def store(response: web.Response) -> CachedResponse:
+    body: bytes = response.body # type: ignore
+    variants = await compression.compress_all_async(body)
+    return make_cached_response(body, variants, response.content_type, response.charset, time.time())
+
+def cached(handler: Callable[[web.Request], Awaitable[web.StreamResponse]]):
+    """
+    Caches the successful responses of a handler of dictionary queries by their normalized parameters and
+    the dictionary version. Streamed responses are not cached.
+    """
+    @functools.wraps(handler)
+    async def wrapper(request: web.Request) -> web.StreamResponse:
+        module = request["dictionary"]
+        key = cache_key(request, module.normalize_query)
+        if key is None:
+            return await handler(request)
+
+        version = module.dictionary.version
+        response_cache.check_version(version)
+        key = (version, key)
+        cached_response = response_cache.get(key)
+        if cached_response is None:
+            response = await handler(request)
+            if type(response) is not web.Response or response.status != 200 or not isinstance(response.body, bytes):
+                return response
+
+            cached_response = await store(response)
+            response_cache.put(key, cached_response, size=len(cached_response.body) + sum(map(len, cached_response.variants.values())))
+
+        return make_response(request, cached_response)
+
+    return wrapper
+
+def static_handler(directory: str):
+    """
+    Returns a handler that serves the files of a directory (the route must have a {filename} part) from memory,
+    with their compressed variants and cache validators. Files are read again when they change.
+    """
+    directory = os.path.abspath(directory)
+    files: Dict[str, Tuple[int, CachedResponse]] = {}
+    async def get_static(request: web.Request) -> web.Response:
+        path = os.path.abspath(os.path.join(directory, request.match_info["filename"]))
+        if not path.startswith(directory + os.sep) or compression.is_variant(path) or not os.path.isfile(path):
+            raise web.HTTPNotFound()
+
+        mtime = os.stat(path).st_mtime_ns
+        if path not in files or files[path][0] != mtime:
+            loop = asyncio.get_event_loop()
+            body, variants = await loop.run_in_executor(None, compression.load_variants, path)
+            content_type, _ = mimetypes.guess_type(path)
+            files[path] = (mtime, make_cached_response(body, variants, content_type or "application/octet-stream", None, mtime / 1e9))
+
+        return make_response(request, files[path][1], max_age=STATIC_MAX_AGE)
+
+    return get_static
@@ -0,0 +1,174 @@
+from array import array
+from bisect import bisect_left
+import re
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    from re import _parser as sre_parse # type: ignore
+except ImportError:
+    import sre_parse # type: ignore
+
+# Entries are identified in the indexes by their position in the dictionary iteration order,
+# so that a sorted candidate set can be scanned in the same order as the full dictionary.
+
+class NgramIndex:
+    """
+    Maps character n-grams to the entries whose text contains them.
+    Grams of every length from `min_n` to `n` are indexed.
+    """
+
+    def __init__(self, texts: Iterable[Tuple[int, str]], n: int = 3, min_n: int = 1):
+        self.n = n
+        self.min_n = min_n
+        self.postings: Dict[str, array] = {}
+        for position, text in texts:
+            grams = set()
+            for length in range(min_n, n+1):
+                for i in range(len(text)-length+1):
+                    grams.add(text[i:i+length])
+
+            for gram in grams:
+                if gram not in self.postings:
+                    self.postings[gram] = array("I")
+
+                self.postings[gram].append(position)
+
+    def lookup(self, substring: str) -> Optional[Set[int]]:
+        """
+        Returns a superset of the entries that contain the substring, or None if the index cannot be used.
+        """
+        if len(substring) < self.min_n:
+            return None
+
+        if len(substring) <= self.n:
+            return set(self.postings.get(substring, ()))
+
+        return self.lookup_all(substring[i:i+self.n] for i in range(len(substring)-self.n+1))
+
+    def regex_candidates(self, pattern: str, flags: int = 0) -> Optional[Set[int]]:
+        """
+        Returns a superset of the entries whose text the regex can match, or None if the regex cannot be indexed.
+        """
+        return self._evaluate(required_literals(pattern, flags))
+
+    def _evaluate(self, requirement: Any) -> Optional[Set[int]]:
+        if requirement is None:
+            return None
+
+        kind, value = requirement
+        if kind == "literal":
+            return self.lookup(value)
+
+        elif kind == "and":
+            ans = None
+            for item in value:
+                candidates = self._evaluate(item)
+                if candidates is None:
+                    continue
+
+                if ans is None:
+                    ans = candidates
+
+                else:
+                    ans &= candidates
+
+            return ans
+
+        else: # or
+            ans = set()
+            for item in value:
+                candidates = self._evaluate(item)
+                if candidates is None:
+                    return None
+
+                ans |= candidates
+
+            return ans
+
+    def lookup_all(self, grams: Iterable[str]) -> Set[int]:
+        """
+        Returns the entries that contain all of the given grams.
+        """
+        postings = sorted((self.postings.get(gram, array("I")) for gram in set(grams)), key=len)
+        if not postings:
+            return set()
+
+        ans = set(postings[0])
+        for posting in postings[1:]:
+            if not ans:
+                break
+
+            ans.intersection_update(posting)
+
+        return ans
+
+class PrefixIndex:
+    """
+    A sorted token list that finds the entries having a token that starts with a given prefix.
+    """
+
+    def __init__(self, tokens: Iterable[Tuple[int, str]]):
+        pairs = sorted(set((token, position) for position, token in tokens))
+        self.tokens: List[str] = [token for token, _ in pairs]
+        self.positions = array("I", [position for _, position in pairs])
+
+    def lookup(self, prefix: str) -> Set[int]:
+        ans = set()
+        i = bisect_left(self.tokens, prefix)
+        while i < len(self.tokens) and self.tokens[i].startswith(prefix):
+            ans.add(self.positions[i])
+            i += 1
+
+        return ans
+
+REPEATS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", sre_parse.MAX_REPEAT)}
+
+def required_literals(pattern: str, flags: int = 0) -> Any:
+    """
+    Extracts the literal strings that every match of the regex must contain.
+    The result is a tree of ("literal", text), ("and", [...]) and ("or", [...]) nodes,
+    or None if nothing is known about the matches (eg. for case-insensitive patterns).
+    """
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+
+    except re.error:
+        return None
+
+    if parsed.state.flags & re.IGNORECASE:
+        return None
+
+    return _required_literals(parsed)
+
+def _required_literals(items) -> Any:
+    required = []
+    run = ""
+    for op, av in items:
+        if op is sre_parse.LITERAL:
+            run += chr(av)
+            continue
+
+        if run:
+            required.append(("literal", run))
+            run = ""
+
+        if op is sre_parse.SUBPATTERN:
+            _, add_flags, _, p = av
+            if not add_flags & re.IGNORECASE:
+                required.append(_required_literals(p))
+
+        elif op is getattr(sre_parse, "ATOMIC_GROUP", None):
+            required.append(_required_literals(av))
+
+        elif op in REPEATS:
+            min_count, _, p = av
+            if min_count >= 1:
+                required.append(_required_literals(p))
+
+        elif op is sre_parse.BRANCH:
+            required.append(("or", [_required_literals(alternative) for alternative in av[1]]))
+
+    if run:
+        required.append(("literal", run))
+
+    return ("and", required)
@@ -0,0 +1,47 @@
+from types import ModuleType
+from typing import List, Optional
+
+import yajwiz
+from yajwiz.analyzer import Analysis, ProofreaderError
+
+from .cache import LRUCache
+
+ANALYSIS_CACHE_SIZE = 32 * 1024 * 1024
+ERRORS_CACHE_SIZE = 16 * 1024 * 1024
+MEMO_TTL = 24 * 60 * 60
+
+# Results of the analyzer by the exact text given to it (dictionary queries give texts normalized with fix_xifan).
+# The results are shared and must not be modified.
+analysis_cache = LRUCache(ANALYSIS_CACHE_SIZE, ttl=MEMO_TTL)
+errors_cache = LRUCache(ERRORS_CACHE_SIZE, ttl=MEMO_TTL)
+
+def check_version():
+    # yajwiz.analyzer is replaced when a new dictionary version is loaded, see reload.py
+    version = yajwiz.analyzer.dictionary.version
+    analysis_cache.check_version(version)
+    errors_cache.check_version(version)
+
+def analyze(word: str, analyzer: Optional[ModuleType] = None) -> List[Analysis]:
+    """
+    Analyzes the word with the current analyzer, or with the given analyzer of an earlier dictionary version
+    (whose results are not memoized).
+    """
+    if analyzer is not None and analyzer is not yajwiz.analyzer:
+        return analyzer.analyze(word)
+    
+    check_version()
+    ans = analysis_cache.get(word)
+    if ans is None:
+        ans = yajwiz.analyze(word)
+        analysis_cache.put(word, ans)
+
+    return ans
+
+def get_errors(text: str) -> List[ProofreaderError]:
+    check_version()
+    ans = errors_cache.get(text)
+    if ans is None:
+        ans = yajwiz.get_errors(text)
+        errors_cache.put(text, ans)
+
+    return ans
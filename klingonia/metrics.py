@@ -0,0 +1,129 @@
+"""
+Counters and histograms in the Prometheus text format, served at /metrics.
+
+Metrics are collected only if KLINGONIA_METRICS is set; otherwise the timers are shared no-op objects and
+the counters are not updated. Metrics of queries executed in a process pool are not collected.
+"""
+
+import bisect
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+ENABLED = os.environ.get("KLINGONIA_METRICS", "") not in {"", "0"}
+
+# upper bounds of the histogram buckets in seconds
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+
+    escaped = [str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in values]
+    return "{" + ",".join(f"{name}=\"{value}\"" for name, value in zip(names, escaped)) + "}"
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.lock = threading.Lock()
+        metrics.append(self)
+
+    def inc(self, amount: float = 1, *labels: str):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def collect(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                yield f"{self.name}{format_labels(self.labels, labels)} {value}"
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: List[float] = BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # bucket counts (not cumulative, the last one is +Inf), sum and count by labels
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self.lock = threading.Lock()
+        metrics.append(self)
+
+    def observe(self, value: float, *labels: str):
+        with self.lock:
+            if labels not in self.values:
+                self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0, 0])
+
+            counts, total = self.values[labels]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+            total[1] += 1
+
+    def collect(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock:
+            for labels, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + [float("inf")], counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    yield f"{self.name}_bucket{format_labels(list(self.labels) + ['le'], list(labels) + [le])} {cumulative}"
+
+                yield f"{self.name}_sum{format_labels(self.labels, labels)} {total[0]}"
+                yield f"{self.name}_count{format_labels(self.labels, labels)} {total[1]}"
+
+metrics: List = []
+
+# functions that return lines of metrics that are computed when they are collected, such as cache statistics
+collectors: List[Callable[[], Iterable[str]]] = []
+
+REQUEST_SECONDS = Histogram("klingonia_request_seconds", "Time to handle a request", ["route", "method", "status"])
+STAGE_SECONDS = Histogram("klingonia_stage_seconds", "Time spent in each stage of handling requests", ["stage"])
+ENTRIES_SCANNED = Counter("klingonia_entries_scanned_total", "Dictionary entries evaluated by query predicates")
+ENTRIES_MATCHED = Counter("klingonia_entries_matched_total", "Dictionary entries matched by query predicates")
+
+class Timer:
+    """
+    Observes the time spent in a with block in STAGE_SECONDS.
+    """
+
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        STAGE_SECONDS.observe(time.perf_counter() - self.start, self.stage)
+
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+NULL_TIMER = NullTimer()
+
+def stage(name: str):
+    return Timer(name) if ENABLED else NULL_TIMER
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in metrics:
+        lines += metric.collect()
+
+    for collector in collectors:
+        lines += collector()
+
+    return "\n".join(lines) + "\n"
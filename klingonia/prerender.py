@@ -0,0 +1,112 @@
+"""
+Prerendered dictionary entries.
+
+The prerender file contains every entry rendered once per locale, link format and with and without derivations.
+Layout: magic, the records as compact JSON, one offset array of little-endian u64s per table,
+a JSON footer (dictionary version, entry ids and table locations), and the offset of the footer.
+
+Usage: python -m klingonia.prerender [path]
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger("prerender")
+
+MAGIC = b"KLPR0001"
+DEFAULT_PATH = "prerendered.bin"
+LINK_FORMATS = ["html", "latex"]
+
+def table_key(language: str, link_format: str, include_derivs: bool) -> str:
+    return f"{language}/{link_format}/{int(include_derivs)}"
+
+def write_prerendered(path: str, version: str, entry_ids: List[str], languages: List[str], render: Callable[[str, str, str, bool], Optional[dict]]):
+    """
+    Writes the prerender file. `render(entry_id, language, link_format, include_derivs)` returns the rendered entry,
+    or None if it cannot be rendered (it is then rendered normally when requested).
+    """
+    tables: Dict[str, int] = {}
+    # a unique temporary file, so that processes writing the prerender file at the same time do not write to the same file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC)
+            offsets: Dict[str, List[int]] = {}
+            for language in languages:
+                for link_format in LINK_FORMATS:
+                    for include_derivs in [True, False]:
+                        key = table_key(language, link_format, include_derivs)
+                        offsets[key] = []
+                        for entry_id in entry_ids:
+                            offsets[key].append(f.tell())
+                            rendered = render(entry_id, language, link_format, include_derivs)
+                            if rendered is not None:
+                                f.write(json.dumps(rendered, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+                        offsets[key].append(f.tell())
+
+            for key, table in offsets.items():
+                tables[key] = f.tell()
+                f.write(struct.pack(f"<{len(table)}Q", *table))
+
+            footer_offset = f.tell()
+            f.write(json.dumps({"version": version, "entry_ids": entry_ids, "tables": tables}).encode("utf-8"))
+            f.write(struct.pack("<Q", footer_offset))
+
+        # replace atomically so that running workers keep their mapping of the old file
+        os.replace(tmp_path, path)
+
+    except:
+        os.unlink(tmp_path)
+        raise
+
+class PrerenderedEntries:
+    """
+    A memory-mapped prerender file. The same pages are shared by all processes that map the file.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a prerender file")
+
+        footer_offset, = struct.unpack_from("<Q", self.map, len(self.map)-8)
+        footer = json.loads(self.map[footer_offset:len(self.map)-8])
+        self.version: str = footer["version"]
+        self.positions = {entry_id: i for i, entry_id in enumerate(footer["entry_ids"])}
+        self.tables: Dict[str, int] = footer["tables"]
+
+    def get_raw(self, entry_id: str, language: str, link_format: str, include_derivs: bool) -> Optional[bytes]:
+        table = self.tables.get(table_key(language, link_format, include_derivs), None)
+        position = self.positions.get(entry_id, None)
+        if table is None or position is None:
+            return None
+
+        start, end = struct.unpack_from("<QQ", self.map, table + 8*position)
+        if start == end:
+            return None
+
+        return self.map[start:end]
+
+    def get(self, entry_id: str, language: str, link_format: str, include_derivs: bool) -> Optional[dict]:
+        raw = self.get_raw(entry_id, language, link_format, include_derivs)
+        if raw is None:
+            return None
+
+        return json.loads(raw)
+
+    def close(self):
+        self.map.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    from . import dictionary
+    dictionary.build_prerendered(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PATH)
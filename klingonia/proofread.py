@@ -1,43 +1,242 @@
-from collections import defaultdict
+import asyncio
+from collections import Counter, defaultdict
+from concurrent.futures import Executor
+import hashlib
 import re
+import secrets
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
 
 import yajwiz
+from yajwiz.analyzer import ProofreaderError
+
+from . import memo, metrics
+from .cache import LRUCache
+
+DIGIT = re.compile(r"\d")
+
+# texts are checked in parallel in chunks of about this many characters
+CHUNK_SIZE = 2048
+
+DOCUMENT_CACHE_SIZE = 16 * 1024 * 1024
+# documents that are not proofread for this many seconds are forgotten
+DOCUMENT_TTL = 60 * 60
 
 def check_and_render(text: str):
-    ans = "<table>"
+    lines = get_lines(text)
+    with metrics.stage("get_errors"):
+        errors = [memo.get_errors(line) for line in lines]
+    
+    return render_lines(lines, errors)
+
+async def check_and_render_parallel(text: str, executor: Optional[Executor]):
+    """
+    Like check_and_render, but the lines that are not in the memo are checked in the executor in chunks.
+    """
+    lines = get_lines(text)
+    errors = await get_line_errors_parallel(lines, executor)
+    return render_lines(lines, errors)
+
+async def get_line_errors_parallel(lines: List[str], executor: Optional[Executor]) -> List[List[ProofreaderError]]:
+    """
+    Returns the errors of each line, checking the lines that are not in the memo in the executor in chunks.
+    """
+    memo.check_version()
+    errors = [memo.errors_cache.get(line) for line in lines]
+    unchecked = [line for line, line_errors in zip(lines, errors) if line_errors is None]
+    loop = asyncio.get_event_loop()
+    with metrics.stage("get_errors"):
+        results = await asyncio.gather(*[loop.run_in_executor(executor, check_lines, chunk) for chunk in chunk_lines(unchecked)])
+    checked = iter([line_errors for result in results for line_errors in result])
+    for i, line in enumerate(lines):
+        if errors[i] is None:
+            errors[i] = next(checked)
+            memo.errors_cache.put(line, errors[i])
+
+    return errors # type: ignore
+
+def get_lines(text: str) -> List[str]:
+    return [line for line in text.split("\n") if line.strip()]
+
+def check_lines(lines: List[str]) -> List[List[ProofreaderError]]:
+    return [yajwiz.get_errors(line) for line in lines]
+
+def chunk_lines(lines: List[str]) -> List[List[str]]:
+    chunks: List[List[str]] = []
+    length = CHUNK_SIZE
+    for line in lines:
+        if length >= CHUNK_SIZE:
+            chunks.append([])
+            length = 0
+
+        chunks[-1].append(line)
+        length += len(line)
+
+    return chunks
+
+def render_lines(lines: List[str], errors: List[List[ProofreaderError]]) -> Tuple[int, str]:
+    ans = ["<table>"]
     n_errors = 0
-    for line in text.split("\n"):
-        if not line.strip():
+    with metrics.stage("proofread_render"):
+        for line, line_errors in zip(lines, errors):
+            count, row = render_line(line, line_errors)
+            n_errors += count
+            ans.append(row)
+
+    ans.append("</table>")
+    return n_errors, "".join(ans)
+
+def render_line(line: str, errors: List[yajwiz.analyzer.ProofreaderError]) -> Tuple[int, str]:
+    """
+    Renders a table row for the line with the errors marked. Returns the number of errors and the row.
+    """
+    errors = sorted(errors, key=lambda e: e.location)
+    error_dict = defaultdict(list)
+    n_errors = 0
+    for error in errors:
+        if DIGIT.search(line[error.location:error.end_location]):
+            continue
+
+        error_dict[error.location].append(error)
+        n_errors += 1
+
+    ans = ["<tr>"]
+    if error_dict:
+        ans.append("<td>⚠️")
+
+    else:
+        ans.append("<td>")
+
+    # spans are opened and closed only inside the line, closing tags before opening tags at the same position
+    opens = {}
+    close_counts = Counter()
+    for location in sorted(error_dict):
+        if location >= len(line):
             continue
-        
-        ans += "<tr>"
-        errors = yajwiz.get_errors(line)
-
-        errors.sort(key=lambda e: e.location)
-        error_dict = defaultdict(list)
-        for error in errors:
-            if re.search(r"\d", line[error.location:error.end_location]):
-                continue
-                
-            error_dict[error.location].append(error)
-            n_errors += 1
-        
-        if error_dict:
-            ans += "<td>⚠️"
-        
+
+        opens[location] = sorted(error_dict[location], key=lambda e: e.end_location)
+        for error in opens[location]:
+            if location < error.end_location < len(line):
+                close_counts[error.end_location] += 1
+
+    ans.append("<td okrand>")
+    prev = 0
+    for i in sorted(opens.keys() | close_counts.keys()):
+        ans.append(line[prev:i])
+        ans.append("</span>" * close_counts[i])
+        for error in opens.get(i, []):
+            ans.append(f'<span class=error title="{error.message}">')
+
+        prev = i
+
+    ans.append(line[prev:])
+    return n_errors, "".join(ans)
+
+async def get_errors_parallel(text: str, executor: Optional[Executor]) -> List[ProofreaderError]:
+    """
+    Returns the same errors as yajwiz.get_errors(text), checking the chunks that are not in the memo in the executor.
+    """
+    chunks = split_text(text)
+    memo.check_version()
+    errors = [memo.errors_cache.get(chunk) for _, chunk in chunks]
+    loop = asyncio.get_event_loop()
+    unchecked = [i for i in range(len(chunks)) if errors[i] is None]
+    results = await asyncio.gather(*[loop.run_in_executor(executor, yajwiz.get_errors, chunks[i][1]) for i in unchecked])
+    for i, result in zip(unchecked, results):
+        errors[i] = result
+        memo.errors_cache.put(chunks[i][1], result)
+
+    return [
+        error._replace(location=error.location+offset, end_location=error.end_location+offset)
+        for (offset, _), chunk_errors in zip(chunks, errors)
+        for error in chunk_errors # type: ignore
+    ]
+
+def split_text(text: str) -> List[Tuple[int, str]]:
+    """
+    Splits the text at line ends to chunks of about CHUNK_SIZE characters. Returns (offset, chunk) pairs.
+
+    The grammar checker looks at the two tokens following 'e', so the text is not split
+    if 'e' is one of the last two tokens before the line end.
+    """
+    chunks: List[Tuple[int, str]] = []
+    start = 0
+    end = 0
+    last_tokens: List[str] = []
+    for line in text.split("\n"):
+        end += len(line) + 1
+        last_tokens += [token for token_type, token in yajwiz.tokenize(line) if token_type != "SPACE"]
+        last_tokens = last_tokens[-2:]
+        if end - start >= CHUNK_SIZE and "'e'" not in last_tokens and end < len(text):
+            chunks.append((start, text[start:end]))
+            start = end
+
+    chunks.append((start, text[start:]))
+    return chunks
+
+class Document(NamedTuple):
+    """
+    The lines of a document as they were last proofread, with their hashes and error counts.
+    """
+    version: str
+    lines: List[str]
+    hashes: List[str]
+    counts: List[int]
+
+# documents of incremental proofreading by id
+documents = LRUCache(DOCUMENT_CACHE_SIZE, ttl=DOCUMENT_TTL)
+
+class UnknownLine(Exception):
+    """
+    Raised when a line is given by a hash that is not in the document, eg. because the document has been forgotten.
+    """
+
+def line_hash(line: str) -> str:
+    return hashlib.sha256(line.encode("utf-8")).hexdigest()[:16]
+
+async def proofread_incremental(document_id: Optional[str], lines: List[Union[str, Dict[str, Any]]], executor: Optional[Executor]) -> Dict[str, Any]:
+    """
+    Proofreads a new version of a document and returns the results of the lines that have changed since the previous
+    version. Each line is either its text or {"hash": line_hash(text)} if it is in the previous version. A new document
+    is created if document_id is None or unknown. The errors of the lines are memoized across documents.
+    """
+    old = documents.get(document_id) if document_id is not None else None
+    if old is None:
+        document_id = secrets.token_urlsafe(16)
+
+    known = dict(zip(old.hashes, old.lines)) if old else {}
+    texts = []
+    for line in lines:
+        if isinstance(line, str):
+            texts.append(line)
+
+        elif line["hash"] in known:
+            texts.append(known[line["hash"]])
+
         else:
-            ans += "<td>"
-        
-        close_dict = defaultdict(lambda: 0)
-        ans += "<td okrand>"
-        for i in range(len(line)):
-            ans += "</span>" * close_dict[i]
-            if i in error_dict:
-                for error in sorted(error_dict[i], key=lambda e: e.end_location):
-                    ans += f'<span class=error title="{error.message}">'
-                    close_dict[error.end_location] += 1
-                
-            ans += line[i]
-
-    ans += "</table>"
-    return n_errors, ans
\ No newline at end of file
+            raise UnknownLine(line["hash"])
+
+    hashes = [line_hash(text) for text in texts]
+    version = yajwiz.analyzer.dictionary.version
+    # all lines have changed if the dictionary has been updated
+    old_hashes = old.hashes if old and old.version == version else []
+    changed = [i for i, h in enumerate(hashes) if i >= len(old_hashes) or old_hashes[i] != h]
+    changed_lines = [texts[i] for i in changed if texts[i].strip()]
+    errors = dict(zip(changed_lines, await get_line_errors_parallel(changed_lines, executor)))
+
+    counts = list(old.counts[:len(texts)]) if old_hashes else []
+    counts += [0] * (len(texts) - len(counts))
+    results = []
+    with metrics.stage("proofread_render"):
+        for i in changed:
+            line_errors = errors.get(texts[i], [])
+            count, row = render_line(texts[i], line_errors) if texts[i].strip() else (0, "")
+            counts[i] = count
+            results.append({"line": i, "hash": hashes[i], "n_errors": count, "render": row, "errors": line_errors})
+
+    documents.put(document_id, Document(version, texts, hashes, counts))
+    return {
+        "document": document_id,
+        "line_count": len(texts),
+        "n_errors": sum(counts),
+        "changed": results,
+    }
@@ -0,0 +1,103 @@
+"""
+Hot reloading of new boQwI' dictionary versions.
+
+A new version is loaded into fresh copies of the yajwiz analyzer and the dictionary module, which build their
+operators and indexes while the old copies keep serving. The new copies then replace the old ones in sys.modules.
+Requests take the current dictionary module when they start and keep using it, so queries that are already running
+finish against the old version (like read-copy-update). The caches of a module belong to its version and
+the memoized analyses are cleared when the analyzer changes.
+"""
+
+import importlib
+import importlib.util
+import logging
+import os
+import sys
+import threading
+from types import ModuleType
+from typing import Callable, Optional
+
+import yajwiz
+import yajwiz.boqwiz
+
+logger = logging.getLogger("reload")
+
+# seconds between checking whether the dictionary file has a new version, 0 disables reloading
+RELOAD_INTERVAL = float(os.environ.get("KLINGONIA_RELOAD_INTERVAL", 60))
+
+# seconds between downloading updates of the dictionary, 0 disables updating
+UPDATE_INTERVAL = float(os.environ.get("KLINGONIA_UPDATE_INTERVAL", 0))
+
+# functions that yajwiz exports from its analyzer module
+ANALYZER_EXPORTS = ["tokenize", "split_to_morphemes", "analyze", "split_to_letters", "split_to_syllables", "get_errors"]
+
+def dictionary_mtime() -> Optional[int]:
+    try:
+        return os.stat(yajwiz.boqwiz.DICTIONARY_PATH).st_mtime_ns
+
+    except OSError:
+        return None
+
+lock = threading.Lock()
+# the modification time of the dictionary file when it was checked last
+checked_mtime = dictionary_mtime()
+
+def current() -> ModuleType:
+    """
+    Returns the dictionary module of the current version. Requests should use the same module until they finish.
+    """
+    return importlib.import_module(__package__ + ".dictionary")
+
+def load_module(name: str) -> ModuleType:
+    """
+    Executes a new copy of a module without replacing the loaded one.
+    """
+    spec = importlib.util.find_spec(name)
+    module = importlib.util.module_from_spec(spec) # type: ignore
+    spec.loader.exec_module(module) # type: ignore
+    return module
+
+def reload_dictionary(prepare: Optional[Callable[[ModuleType], None]] = None) -> Optional[ModuleType]:
+    """
+    Loads the dictionary file if it has changed and contains a new version. `prepare` is called with the new
+    dictionary module before it replaces the current one. Returns the new module, or None if the version is the same.
+    """
+    global checked_mtime
+    with lock:
+        mtime = dictionary_mtime()
+        if mtime is None or mtime == checked_mtime:
+            return None
+
+        checked_mtime = mtime
+        data = yajwiz.boqwiz._try_load()
+        if not data or data["version"] == current().dictionary.version:
+            return None
+
+        logger.info("Loading dictionary version %s", data["version"])
+        old_dictionary = yajwiz.boqwiz.cached_dictionary
+        # the new modules load the dictionary with yajwiz.load_dictionary() when they are executed
+        yajwiz.boqwiz.cached_dictionary = yajwiz.BoqwizDictionary.from_json(data)
+        try:
+            analyzer = load_module("yajwiz.analyzer")
+            module = load_module(__package__ + ".dictionary")
+            module.analyzer = analyzer # type: ignore
+            if prepare:
+                prepare(module)
+
+        except:
+            yajwiz.boqwiz.cached_dictionary = old_dictionary
+            raise
+
+        publish(module)
+        logger.info("Dictionary version %s is in use", data["version"])
+        return module
+
+def publish(module: ModuleType):
+    analyzer = module.analyzer # type: ignore
+    sys.modules["yajwiz.analyzer"] = analyzer
+    yajwiz.analyzer = analyzer # type: ignore
+    for name in ANALYZER_EXPORTS:
+        setattr(yajwiz, name, getattr(analyzer, name))
+
+    sys.modules[module.__name__] = module
+    setattr(sys.modules[__package__], "dictionary", module)
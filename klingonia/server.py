@@ -1,18 +1,175 @@
+import asyncio
 from collections import defaultdict
-from klingonia.proofread import check_and_render
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+import contextlib
+import functools
+from klingonia.proofread import UnknownLine, check_and_render_parallel, get_errors_parallel, proofread_incremental
 from aiohttp import web
 import aiohttp_jinja2
 import jinja2
 import yajwiz
 
+import json
 import logging
+import os
+import sys
+import threading
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional, Tuple
 
-from . import locales, dictionary
+from . import compression, httpcache, locales, memo, metrics, reload, templating, workers
 
 logging.basicConfig(level=logging.INFO)
 
+HOST = os.environ.get("KLINGONIA_HOST", "0.0.0.0")
+PORT = int(os.environ.get("KLINGONIA_PORT", 8080))
+
+# number of processes used for grammar checking by each server process; 0 checks texts in a thread of the server process
+PROOFREAD_WORKERS = int(os.environ.get("KLINGONIA_PROOFREAD_WORKERS", (os.cpu_count() or 1) // workers.WORKERS))
+
+# dictionary queries are executed in a pool of threads or processes
+QUERY_EXECUTOR = os.environ.get("KLINGONIA_QUERY_EXECUTOR", "thread")
+QUERY_WORKERS = int(os.environ.get("KLINGONIA_QUERY_WORKERS", 4))
+# CPU time limit of a single query in seconds
+QUERY_CPU_LIMIT = float(os.environ.get("KLINGONIA_QUERY_CPU_LIMIT", 2.0))
+# wall-clock time limit including the time spent waiting for a worker
+QUERY_TIMEOUT = float(os.environ.get("KLINGONIA_QUERY_TIMEOUT", 10.0))
+# queries that are running or waiting for a worker; more queries than this are rejected with 503
+QUERY_QUEUE_SIZE = int(os.environ.get("KLINGONIA_QUERY_QUEUE_SIZE", 32))
+# maximum number of queries in a batch request
+MAX_BATCH_SIZE = int(os.environ.get("KLINGONIA_MAX_BATCH_SIZE", 100))
+# the time limits of a batch are those of this many single queries at most
+MAX_BATCH_COST = int(os.environ.get("KLINGONIA_MAX_BATCH_COST", 10))
+# number of results (or template fragments) produced at a time when streaming
+STREAM_CHUNK_SIZE = 32
+
 routes = web.RouteTableDef()
 
+async def run_dictionary_query(request: web.Request, query: str, lang: str, link_format: str, offset: int = 0, limit: Optional[int] = None, rank: bool = False):
+    function = functools.partial(request["dictionary"].dictionary_query, offset=offset, limit=limit, rank=rank)
+    return await run_query_job(request, function, query, lang, link_format)
+
+class PendingQueries:
+    """
+    The number of queries that are running or waiting for a worker. The application cannot be modified after it has
+    started, so it holds one instance that is modified instead.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+@contextlib.contextmanager
+def query_slot(app: web.Application, cost: int = 1):
+    """
+    Counts a job of `cost` queries as pending while it runs, or rejects it if the queue does not have room for it.
+    A job that costs more than the whole queue needs the queue to be empty.
+    """
+    pending: PendingQueries = app["query_pending"]
+    cost = min(cost, QUERY_QUEUE_SIZE)
+    if pending.count + cost > QUERY_QUEUE_SIZE:
+        raise web.HTTPServiceUnavailable(text="Too many queries, please try again later")
+    
+    pending.count += cost
+    try:
+        yield
+    
+    finally:
+        pending.count -= cost
+
+async def run_query_job(request: web.Request, function, *args, cost: int = 1):
+    """
+    Runs function(*args, cpu_limit, cancel) in the query pool. `cost` is the number of queries the job contains;
+    the job takes that many places in the queue and its time limits are those of at most MAX_BATCH_COST queries.
+    """
+    # processes cannot share the event, so queries in a process pool can only be stopped by the CPU time limit
+    cancel = threading.Event() if QUERY_EXECUTOR == "thread" else None
+    budget = min(cost, MAX_BATCH_COST)
+    with query_slot(request.app, cost):
+        try:
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(request.app["pools"].query, function, *args, QUERY_CPU_LIMIT * budget, cancel)
+            return await asyncio.wait_for(future, QUERY_TIMEOUT * budget)
+        
+        except (request["dictionary"].QueryTimeout, asyncio.TimeoutError):
+            raise web.HTTPServiceUnavailable(text="The query took too long")
+        
+        finally:
+            # stops the query if it is still running, eg. if the client disconnected
+            if cancel:
+                cancel.set()
+
+async def query_chunks(request: web.Request, query: Any, iterator: Iterator[Any], chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[List[Any]]:
+    """
+    Advances an iterator that executes the query in the query pool (which must be a thread pool) a chunk at a time.
+    """
+    cancel = threading.Event()
+    query.cancel = cancel
+    with query_slot(request.app):
+        try:
+            loop = asyncio.get_event_loop()
+            while True:
+                future = loop.run_in_executor(request.app["pools"].query, query.take, iterator, chunk_size)
+                chunk = await asyncio.wait_for(future, QUERY_TIMEOUT)
+                if chunk:
+                    yield chunk
+                
+                if len(chunk) < chunk_size:
+                    return
+        
+        except (request["dictionary"].QueryTimeout, asyncio.TimeoutError):
+            raise web.HTTPServiceUnavailable(text="The query took too long")
+        
+        finally:
+            cancel.set()
+
+async def result_chunks(request: web.Request, query: str, lang: str, link_format: str, offset: int, limit: Optional[int], rank: bool) -> AsyncIterator[List[dict]]:
+    """
+    Yields the results of a query in chunks. With a thread pool the query is executed lazily,
+    otherwise it is executed at once in a process and only the response is streamed.
+    """
+    if QUERY_EXECUTOR == "thread":
+        q = request["dictionary"].DictionaryQuery(query, lang, link_format, cpu_limit=QUERY_CPU_LIMIT)
+        async for chunk in query_chunks(request, q, q.iter_results(offset, limit, rank)):
+            yield chunk
+    
+    else:
+        results = await run_dictionary_query(request, query, lang, link_format, offset, limit, rank)
+        for i in range(0, len(results), STREAM_CHUNK_SIZE):
+            yield results[i:i+STREAM_CHUNK_SIZE]
+
+async def first_chunk(chunks: AsyncIterator[List[Any]]) -> List[Any]:
+    """
+    Returns the first chunk, so that errors before it can still be reported with a status code.
+    """
+    try:
+        return await chunks.__anext__()
+    
+    except StopAsyncIteration:
+        return []
+
+def get_pagination(request: web.Request) -> Tuple[int, Optional[int]]:
+    try:
+        offset = int(request.query.get("offset", 0))
+        limit = int(request.query["limit"]) if "limit" in request.query else None
+    
+    except ValueError:
+        raise web.HTTPBadRequest(text="offset and limit must be integers")
+    
+    if offset < 0 or limit is not None and limit < 0:
+        raise web.HTTPBadRequest(text="offset and limit must not be negative")
+    
+    return offset, limit
+
+def get_rank(request: web.Request) -> bool:
+    """
+    Returns whether the results should be ordered by relevance (sort=relevance) instead of the default order.
+    """
+    sort = request.query.get("sort", "")
+    if sort not in {"", "relevance"}:
+        raise web.HTTPBadRequest(text="sort must be 'relevance'")
+    
+    return sort == "relevance"
+
 @routes.get('/')
 @routes.get('/index/{lang}')
 @routes.get('/index/{lang}/')
@@ -35,31 +192,161 @@ async def get_proofread(request):
 @routes.get('/dictionary/')
 @routes.get('/dictionary/{lang}')
 @routes.get('/dictionary/{lang}/')
+@httpcache.cached
 @aiohttp_jinja2.template("dictionary.jinja2")
 async def get_dictionary(request: web.Request):
     lang = request.match_info.get("lang", "en")
-    query = request.query.get("q", "")
+    query = request["dictionary"].normalize_query(request.query.get("q", ""))
     bare = request.query.get("bare", "") != ""
-    return {
+    offset, limit = get_pagination(request)
+    rank = get_rank(request)
+    context = {
         "lang": locales.locale_map[lang],
         "path": "/dictionary",
         "input": query,
-        "result": dictionary.dictionary_query(query, lang, link_format="html"),
-        "boqwiz_version": dictionary.dictionary.version,
+        "boqwiz_version": request["dictionary"].dictionary.version,
         "bare": bare
     }
+    if request.query.get("stream", "") and query and QUERY_EXECUTOR == "thread":
+        # the results are rendered while the template is being generated
+        q = request["dictionary"].DictionaryQuery(query, lang, "html", cpu_limit=QUERY_CPU_LIMIT)
+        context["result"] = q.iter_results(offset, limit, rank)
+        template = aiohttp_jinja2.get_env(request.app).get_template("dictionary.jinja2")
+        chunks = query_chunks(request, q, template.generate(context), chunk_size=256)
+        try:
+            first = await first_chunk(chunks)
+            response = web.StreamResponse(headers={"Content-Type": "text/html; charset=utf-8"})
+            await response.prepare(request)
+            await response.write("".join(first).encode("utf-8"))
+            try:
+                async for chunk in chunks:
+                    await response.write("".join(chunk).encode("utf-8"))
+            
+            except web.HTTPServiceUnavailable as e:
+                await response.write(f"<p>{e.text}</p>".encode("utf-8"))
+        
+        finally:
+            await chunks.aclose()
+        
+        await response.write_eof()
+        return response
+    
+    context["result"] = await run_dictionary_query(request, query, lang, link_format="html", offset=offset, limit=limit, rank=rank)
+    return context
 
 @routes.get("/api/dictionary")
+@httpcache.cached
 async def api_dictionary(request: web.Request):
+    """
+    Executes a query. With stream=json the same JSON object is sent in chunks, with stream=ndjson
+    each result is sent on its own line. offset and limit select a part of the results, and with
+    sort=relevance the results are ordered by relevance and only the selected ones are rendered.
+    With explain=1 the query plan is returned instead of the results: the parsed query tree with the
+    evaluations, matches, time, errors and index use of each node.
+    """
     lang = request.query.get("lang", "en")
-    query = request.query.get("q", "")
+    query = request["dictionary"].normalize_query(request.query.get("q", ""))
     link_format = request.query.get("link_format", "html")
     if link_format != "html" and link_format != "latex":
         raise web.HTTPBadRequest(text="link_format must be either 'html' or 'latex'")
+    offset, limit = get_pagination(request)
+    rank = get_rank(request)
+    stream = request.query.get("stream", "")
+    if stream not in {"", "json", "ndjson"}:
+        raise web.HTTPBadRequest(text="stream must be either 'json' or 'ndjson'")
+    
+    if request.query.get("explain", "") and query:
+        return web.json_response({
+            "input": query,
+            "explain": await run_query_job(request, request["dictionary"].explain_query, query, lang),
+            "boqwiz_version": request["dictionary"].dictionary.version
+        })
+    
+    if stream and query:
+        return await stream_dictionary_query(request, query, lang, link_format, offset, limit, rank, stream)
+    
     return web.json_response({
         "input": query,
-        "result": dictionary.dictionary_query(query, lang, link_format),
-        "boqwiz_version": dictionary.dictionary.version
+        "result": await run_dictionary_query(request, query, lang, link_format, offset, limit, rank),
+        "boqwiz_version": request["dictionary"].dictionary.version
+    })
+
+async def stream_dictionary_query(request: web.Request, query: str, lang: str, link_format: str, offset: int, limit: Optional[int], rank: bool, stream: str) -> web.StreamResponse:
+    chunks = result_chunks(request, query, lang, link_format, offset, limit, rank)
+    try:
+        first = await first_chunk(chunks)
+        if stream == "ndjson":
+            response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+            await response.prepare(request)
+            await response.write("".join(json.dumps(result) + "\n" for result in first).encode("utf-8"))
+            try:
+                async for chunk in chunks:
+                    await response.write("".join(json.dumps(result) + "\n" for result in chunk).encode("utf-8"))
+            
+            except web.HTTPServiceUnavailable as e:
+                await response.write((json.dumps({"error": e.text}) + "\n").encode("utf-8"))
+        
+        else:
+            response = web.StreamResponse(headers={"Content-Type": "application/json"})
+            await response.prepare(request)
+            await response.write(("{\"input\": " + json.dumps(query) + ", \"boqwiz_version\": " + json.dumps(request["dictionary"].dictionary.version) + ", \"result\": [").encode("utf-8"))
+            await response.write(", ".join(json.dumps(result) for result in first).encode("utf-8"))
+            error = None
+            try:
+                async for chunk in chunks:
+                    await response.write(("".join(", " + json.dumps(result) for result in chunk)).encode("utf-8"))
+            
+            except web.HTTPServiceUnavailable as e:
+                error = e.text
+            
+            await response.write(("]" + (", \"error\": " + json.dumps(error) if error else "") + "}").encode("utf-8"))
+    
+    finally:
+        await chunks.aclose()
+    
+    await response.write_eof()
+    return response
+
+@routes.post("/api/dictionary/batch")
+async def api_dictionary_batch(request: web.Request):
+    """
+    Executes many queries at once. The body is a JSON object with the fields
+    "queries" (list of strings), "lang", "link_format" and "format" ("json" or "ndjson").
+    """
+    try:
+        body = await request.json()
+    
+    except ValueError:
+        raise web.HTTPBadRequest(text="The body must be a JSON object")
+    
+    queries = body.get("queries", None) if isinstance(body, dict) else None
+    if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+        raise web.HTTPBadRequest(text="queries must be a list of strings")
+    
+    if len(queries) > MAX_BATCH_SIZE:
+        raise web.HTTPBadRequest(text=f"At most {MAX_BATCH_SIZE} queries are allowed in a batch")
+    
+    lang = body.get("lang", "en")
+    if not isinstance(lang, str) or lang not in locales.locale_map:
+        raise web.HTTPBadRequest(text="Unknown lang")
+    
+    link_format = body.get("link_format", "html")
+    if link_format != "html" and link_format != "latex":
+        raise web.HTTPBadRequest(text="link_format must be either 'html' or 'latex'")
+    
+    results = await run_query_job(request, request["dictionary"].batch_query, queries, lang, link_format, cost=max(1, len(queries)))
+    if body.get("format", "json") == "ndjson" or "application/x-ndjson" in request.headers.get("Accept", ""):
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        for query, result in results.items():
+            await response.write((json.dumps({"input": query, "result": result}) + "\n").encode("utf-8"))
+        
+        await response.write_eof()
+        return response
+    
+    return web.json_response({
+        "results": results,
+        "boqwiz_version": request["dictionary"].dictionary.version
     })
 
 @routes.get("/api/analyze")
@@ -67,27 +354,223 @@ async def api_analyze(request):
     if "word" not in request.query:
         raise web.HTTPBadRequest()
     word = request.query["word"]
-    return web.json_response(yajwiz.analyze(word))
+    return web.json_response(memo.analyze(word, request["dictionary"].analyzer))
+
+@routes.get("/api/stats")
+async def api_stats(request):
+    return web.json_response({
+        "render_cache": request["dictionary"].render_cache.stats(),
+        "analysis_cache": memo.analysis_cache.stats(),
+        "errors_cache": memo.errors_cache.stats(),
+        "response_cache": httpcache.response_cache.stats(),
+        "fragment_cache": templating.fragment_cache.stats(),
+    })
+
+@routes.get("/metrics")
+async def get_metrics(request):
+    if not metrics.ENABLED:
+        raise web.HTTPNotFound(text="Metrics are not enabled")
+    
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+def collect_server_metrics(app: web.Application):
+    caches = {
+        "render": reload.current().render_cache,
+        "analysis": memo.analysis_cache,
+        "errors": memo.errors_cache,
+        "response": httpcache.response_cache,
+        "fragment": templating.fragment_cache,
+    }
+    for name, kind, field in [
+        ("klingonia_cache_entries", "gauge", "entries"),
+        ("klingonia_cache_bytes", "gauge", "bytes"),
+        ("klingonia_cache_hits_total", "counter", "hits"),
+        ("klingonia_cache_misses_total", "counter", "misses"),
+        ("klingonia_cache_evictions_total", "counter", "evictions"),
+        ("klingonia_cache_expirations_total", "counter", "expirations"),
+    ]:
+        yield f"# TYPE {name} {kind}"
+        for cache_name, cache in caches.items():
+            yield f"{name}{{cache=\"{cache_name}\"}} {cache.stats()[field]}"
+    
+    yield "# TYPE klingonia_queries_pending gauge"
+    yield f"klingonia_queries_pending {app['query_pending'].count if 'query_pending' in app else 0}"
 
 @routes.post("/api/grammar_check")
 async def api_grammar_check(request):
     text = await request.text()
-    errors = yajwiz.get_errors(text)
+    errors = await get_errors_parallel(text, request.app["pools"].proofread)
     return web.json_response(errors)
 
 @routes.post("/api/proofread")
 async def api_proofread(request):
     lang = request.match_info.get("lang", "en")
     text = await request.text()
-    n_errors, render = check_and_render(text)
+    n_errors, render = await check_and_render_parallel(text, request.app["pools"].proofread)
     return web.json_response({
         "n_errors": n_errors,
         "render": render,
     })
 
-routes.static('/static/', "static/")
+@routes.post("/api/proofread/incremental")
+async def api_proofread_incremental(request: web.Request):
+    """
+    Proofreads a document that is edited, returning only the results of the changed lines. The body is a JSON object:
+    "document" is the id returned by the previous request (omitted for a new document) and "lines" is the list of
+    lines of the document, each either its text or {"hash": hash} if it has not changed since the previous request.
+    The hash is the first 16 hex digits of the SHA-256 of the UTF-8 text. Lines are checked one by one, so errors
+    are located within their line. If the document has been forgotten, responds with 409 and the client should send
+    all lines as text.
+    """
+    try:
+        body = await request.json()
+    
+    except ValueError:
+        raise web.HTTPBadRequest(text="The body must be a JSON object")
+    
+    lines = body.get("lines", None) if isinstance(body, dict) else None
+    if not isinstance(lines, list) or not all(isinstance(line, str) or isinstance(line, dict) and isinstance(line.get("hash"), str) for line in lines):
+        raise web.HTTPBadRequest(text="lines must be a list of strings and {\"hash\": string} objects")
+    
+    document = body.get("document", None)
+    if document is not None and not isinstance(document, str):
+        raise web.HTTPBadRequest(text="document must be a string")
+    
+    try:
+        result = await proofread_incremental(document, lines, request.app["pools"].proofread)
+    
+    except UnknownLine:
+        raise web.HTTPConflict(text="Unknown line hash, send all lines as text")
+    
+    return web.json_response(result)
+
+routes.get("/static/{filename:.+}")(httpcache.static_handler("static/"))
+
+def prepare_dictionary(module):
+    if "KLINGONIA_PRERENDER" in os.environ:
+        module.load_prerendered(os.environ["KLINGONIA_PRERENDER"])
+
+prepare_dictionary(reload.current())
+
+@web.middleware
+async def measure_latency(request: web.Request, handler):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource else "unmatched"
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, route, request.method, str(status))
+
+class TimedTemplate(jinja2.Template):
+    def render(self, *args, **kwargs) -> str:
+        with metrics.stage("template"):
+            return super().render(*args, **kwargs)
+
+@web.middleware
+async def use_dictionary_version(request: web.Request, handler):
+    # a request uses the same dictionary version until it finishes, even if a new version is loaded meanwhile
+    request["dictionary"] = reload.current()
+    return await handler(request)
+
+class Pools:
+    """
+    The executors of proofreading and dictionary queries. Process pools are replaced when a new dictionary version is
+    loaded, and the application cannot be modified after it has started, so it holds one instance whose pools are
+    replaced instead.
+    """
+
+    def __init__(self):
+        self.proofread: Optional[ProcessPoolExecutor] = None
+        self.query: Optional[Executor] = None
+
+async def start_proofread_pool(app: web.Application):
+    app["pools"].proofread = ProcessPoolExecutor(PROOFREAD_WORKERS) if PROOFREAD_WORKERS > 0 else None
+
+async def stop_proofread_pool(app: web.Application):
+    if app["pools"].proofread:
+        app["pools"].proofread.shutdown()
+
+async def start_query_pool(app: web.Application):
+    app["pools"].query = ProcessPoolExecutor(QUERY_WORKERS) if QUERY_EXECUTOR == "process" else ThreadPoolExecutor(QUERY_WORKERS)
+    app["query_pending"] = PendingQueries()
+
+async def stop_query_pool(app: web.Application):
+    app["pools"].query.shutdown()
+
+async def restart_process_pools(app: web.Application):
+    """
+    Replaces the process pools, whose workers have the modules of the previous dictionary version.
+    Jobs that were already submitted finish in the old workers.
+    """
+    pools: Pools = app["pools"]
+    if pools.proofread:
+        old_pool = pools.proofread
+        pools.proofread = ProcessPoolExecutor(PROOFREAD_WORKERS)
+        old_pool.shutdown(wait=False)
+    
+    if QUERY_EXECUTOR == "process":
+        old_pool = pools.query
+        pools.query = ProcessPoolExecutor(QUERY_WORKERS)
+        old_pool.shutdown(wait=False)
+
+async def reload_dictionary(app: web.Application):
+    """
+    Periodically downloads dictionary updates (if enabled) and loads new versions in a thread.
+    """
+    loop = asyncio.get_event_loop()
+    since_update = 0.0
+    while True:
+        await asyncio.sleep(reload.RELOAD_INTERVAL)
+        try:
+            since_update += reload.RELOAD_INTERVAL
+            if reload.UPDATE_INTERVAL and since_update >= reload.UPDATE_INTERVAL:
+                since_update = 0.0
+                await loop.run_in_executor(None, yajwiz.update_dictionary)
+            
+            if await loop.run_in_executor(None, reload.reload_dictionary, prepare_dictionary):
+                await restart_process_pools(app)
+        
+        except asyncio.CancelledError:
+            raise
+        
+        except:
+            logging.exception("Error while reloading the dictionary", exc_info=sys.exc_info())
+
+async def start_reloader(app: web.Application):
+    app["reloader"] = asyncio.ensure_future(reload_dictionary(app)) if reload.RELOAD_INTERVAL > 0 else None
+
+async def stop_reloader(app: web.Application):
+    if app["reloader"]:
+        app["reloader"].cancel()
+
+def make_app() -> web.Application:
+    app = web.Application(middlewares=([measure_latency] if metrics.ENABLED else []) + [use_dictionary_version, compression.compress_responses])
+    app["pools"] = Pools()
+    app.on_startup.append(start_proofread_pool)
+    app.on_startup.append(start_query_pool)
+    app.on_startup.append(start_reloader)
+    app.on_cleanup.append(stop_reloader)
+    app.on_cleanup.append(stop_proofread_pool)
+    app.on_cleanup.append(stop_query_pool)
+    templating.setup(app, template_class=TimedTemplate if metrics.ENABLED else None)
+    if metrics.ENABLED:
+        metrics.collectors.append(functools.partial(collect_server_metrics, app))
+    
+    app.add_routes(routes)
+    return app
 
-app = web.Application()
-aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader('templates/'))
-app.add_routes(routes)
-web.run_app(app)
+if __name__ == "__main__":
+    if workers.WORKERS > 1:
+        workers.serve(make_app, prepare_dictionary, HOST, PORT, workers.WORKERS)
+    
+    else:
+        web.run_app(make_app(), host=HOST, port=PORT, shutdown_timeout=workers.SHUTDOWN_TIMEOUT)
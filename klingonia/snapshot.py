@@ -0,0 +1,86 @@
+"""
+Snapshots of the derived and search indexes, so that they do not have to be rebuilt on every startup.
+
+The snapshot file contains pickled sections followed by a pickled footer (format, dictionary version,
+section locations) and the offset of the footer. Sections are unpickled only when they are first used.
+"""
+
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+from typing import Any, Dict, Iterable, Tuple
+
+MAGIC = b"KLSN0001"
+
+def write_snapshot(path: str, header: Dict[str, Any], sections: Iterable[Tuple[str, Any]]):
+    locations: Dict[str, Tuple[int, int]] = {}
+    # a unique temporary file, so that processes saving the same snapshot do not write to the same file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC)
+            for name, value in sections:
+                data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+                locations[name] = (f.tell(), len(data))
+                f.write(data)
+
+            footer_offset = f.tell()
+            f.write(pickle.dumps({"header": header, "sections": locations}, protocol=pickle.HIGHEST_PROTOCOL))
+            f.write(struct.pack("<Q", footer_offset))
+
+        os.replace(tmp_path, path)
+
+    except:
+        os.unlink(tmp_path)
+        raise
+
+class Snapshot:
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a snapshot file")
+
+        footer_offset, = struct.unpack_from("<Q", self.map, len(self.map)-8)
+        footer = pickle.loads(self.map[footer_offset:len(self.map)-8])
+        self.header: Dict[str, Any] = footer["header"]
+        self.sections: Dict[str, Tuple[int, int]] = footer["sections"]
+
+    def load(self, name: str) -> Any:
+        offset, length = self.sections[name]
+        return pickle.loads(self.map[offset:offset+length])
+
+class LazySections(dict):
+    """
+    A dict of snapshot sections named `prefix + key` that are unpickled when first accessed.
+    """
+
+    def __init__(self, snapshot: Snapshot, prefix: str):
+        super().__init__()
+        self.snapshot = snapshot
+        self.prefix = prefix
+        self.names = {name[len(prefix):] for name in snapshot.sections if name.startswith(prefix)}
+
+    def __missing__(self, key):
+        if key not in self.names:
+            raise KeyError(key)
+
+        value = self.snapshot.load(self.prefix + key)
+        self[key] = value
+        return value
+
+    def __contains__(self, key) -> bool:
+        return key in self.names or super().__contains__(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def load_all(self):
+        """
+        Unpickles the sections that have not been accessed yet.
+        """
+        for key in self.names:
+            self[key]
@@ -0,0 +1,114 @@
+"""
+A compact store of the relations between dictionary entries.
+
+Entries are referred to by their integer positions and the relations are posting lists in arrays. Arrays do not
+contain Python objects, so worker processes forked from a parent share them copy-on-write without touching
+their reference counts.
+"""
+
+from array import array
+import sys
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from yajwiz.boqwiz import BoqwizDictionary
+
+class Postings:
+    """
+    Lists of integers by integer key, stored in two arrays (compressed sparse rows).
+    """
+
+    __slots__ = ("offsets", "values")
+
+    def __init__(self, lists: Iterable[Iterable[int]]):
+        self.offsets = array("I", [0])
+        self.values = array("I")
+        for values in lists:
+            self.values.extend(values)
+            self.offsets.append(len(self.values))
+
+    def __getitem__(self, key: int) -> Sequence[int]:
+        return self.values[self.offsets[key]:self.offsets[key+1]]
+
+    def count(self, key: int) -> int:
+        return self.offsets[key+1] - self.offsets[key]
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+class KeyPostings:
+    """
+    Lists of integers by string key: the keys map to rows of Postings in sorted key order.
+    """
+
+    __slots__ = ("keys", "postings")
+
+    def __init__(self, items: Iterable[Tuple[str, Iterable[int]]]):
+        lists: Dict[str, List[int]] = {}
+        for key, values in items:
+            lists.setdefault(sys.intern(key), []).extend(values)
+
+        self.keys = {key: i for i, key in enumerate(sorted(lists))}
+        self.postings = Postings(sorted(set(lists[key])) for key in sorted(lists))
+
+    def get(self, key: str, default: Sequence[int] = ()) -> Sequence[int]:
+        if key not in self.keys:
+            return default
+
+        return self.postings[self.keys[key]]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys
+
+class EntryStore:
+    """
+    The entry ids in dictionary order, the link graph of components and derived entries, and the search tag postings by language.
+    """
+
+    __slots__ = ("ids", "positions", "components", "derived", "search_tags")
+
+    def __init__(self, dictionary: BoqwizDictionary, get_links):
+        entries = list(dictionary.entries.values())
+        self.ids = [sys.intern(entry.id) for entry in entries]
+        self.positions = {entry_id: position for position, entry_id in enumerate(self.ids)}
+
+        # the entries linked from the components of each entry; a link without a homonym number also refers to homonym 1
+        self.components = Postings(
+            [
+                self.positions[target]
+                for component in get_links(entry.components or "")
+                for target in ([component, component + ":1"] if component.count(":") == 1 else [component])
+                if target in self.positions
+            ]
+            for entry in entries
+        )
+
+        # an entry is derived from its components, except for sentences
+        derived: List[List[int]] = [[] for _ in entries]
+        for position, entry in enumerate(entries):
+            if "sen" in entry.tags:
+                continue
+
+            for component in self.components[position]:
+                derived[component].append(position)
+
+        self.derived = Postings(derived)
+        self.search_tags = {
+            language: KeyPostings(
+                (tag, [position])
+                for position, entry in enumerate(entries)
+                for tag in entry.search_tags.get(language, [])
+            )
+            for language in dictionary.locales
+        }
+
+    def derived_positions(self, entry_id: str) -> Sequence[int]:
+        if entry_id not in self.positions:
+            return ()
+
+        return self.derived[self.positions[entry_id]]
+
+    def derived_count(self, entry_id: str) -> int:
+        if entry_id not in self.positions:
+            return 0
+
+        return self.derived.count(self.positions[entry_id])
@@ -0,0 +1,68 @@
+"""
+The Jinja environment of the server.
+
+Templates are compiled once and their bytecode is cached on disk, so that new server processes do not compile them
+again. Templates are not reloaded when they change unless KLINGONIA_TEMPLATE_RELOAD is set. The HTML of each
+dictionary entry (entry.jinja2) is cached by entry id, language and dictionary version, so that a page of results
+is mostly a concatenation of cached fragments.
+"""
+
+import functools
+import logging
+import os
+import sys
+from typing import Optional, Type
+
+from aiohttp import web
+import aiohttp_jinja2
+import appdirs
+import jinja2
+from markupsafe import Markup
+
+from .cache import LRUCache
+
+logger = logging.getLogger("templating")
+
+TEMPLATE_DIR = "templates/"
+BYTECODE_CACHE_DIR = os.environ.get("KLINGONIA_TEMPLATE_CACHE", os.path.join(appdirs.user_cache_dir("klingonia"), "templates"))
+AUTO_RELOAD = os.environ.get("KLINGONIA_TEMPLATE_RELOAD", "") not in {"", "0"}
+
+FRAGMENT_CACHE_SIZE = 32 * 1024 * 1024
+
+# HTML of rendered entries by (dictionary version, entry id, language id)
+fragment_cache = LRUCache(FRAGMENT_CACHE_SIZE)
+
+def entry_html(env: jinja2.Environment, entry: dict, lang: dict, version: str) -> Markup:
+    """
+    Renders a result of a dictionary query with entry.jinja2 or returns it from the fragment cache.
+    """
+    # prerender files written before entries had ids cannot be cached
+    if "id" not in entry:
+        return Markup("".join(env.get_template("entry.jinja2").generate(entry=entry, lang=lang)))
+
+    # requests that still use the previous dictionary version after a reload get fragments of their own version;
+    # fragments of old versions are evicted as the cache fills up
+    key = (version, entry["id"], lang["id"])
+    html = fragment_cache.get(key)
+    if html is None:
+        # generate instead of render, so that the time of fragments is not counted twice by TimedTemplate
+        html = Markup("".join(env.get_template("entry.jinja2").generate(entry=entry, lang=lang)))
+        fragment_cache.put(key, html, size=sys.getsizeof(html))
+
+    return html
+
+def bytecode_cache() -> Optional[jinja2.BytecodeCache]:
+    try:
+        os.makedirs(BYTECODE_CACHE_DIR, exist_ok=True)
+        return jinja2.FileSystemBytecodeCache(BYTECODE_CACHE_DIR)
+
+    except OSError:
+        logger.exception("Could not create the template cache directory %s", BYTECODE_CACHE_DIR, exc_info=sys.exc_info())
+        return None
+
+def setup(app: web.Application, template_class: Optional[Type[jinja2.Template]] = None):
+    env = aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader(TEMPLATE_DIR), bytecode_cache=bytecode_cache(), auto_reload=AUTO_RELOAD)
+    if template_class:
+        env.template_class = template_class
+
+    env.globals["entry_html"] = functools.partial(entry_html, env)
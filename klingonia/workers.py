@@ -0,0 +1,202 @@
+"""
+A pre-forking server with several worker processes.
+
+The parent process loads the dictionary and its indexes once and forks the workers, which share those pages
+copy-on-write (gc.freeze() keeps the garbage collector of the workers from writing to them). The workers accept
+connections from one listening socket created by the parent, so a worker that stops does not lose connections
+waiting in the backlog. The parent restarts workers that exit, downloads dictionary updates and loads new versions,
+after which it replaces the workers with ones that share the new version.
+
+Signals to the parent: SIGTERM and SIGINT stop the workers gracefully and SIGHUP replaces them with new ones.
+"""
+
+import asyncio
+import gc
+import logging
+import os
+import random
+import signal
+import socket
+import sys
+import time
+from types import ModuleType
+from typing import Callable, Dict, Set
+
+from aiohttp import web
+
+import yajwiz
+
+from . import reload
+
+logger = logging.getLogger("workers")
+
+# number of server processes; with 1 the server runs in the main process
+WORKERS = int(os.environ.get("KLINGONIA_WORKERS", 1))
+# a worker is replaced after handling about this many requests, 0 disables recycling
+MAX_REQUESTS = int(os.environ.get("KLINGONIA_MAX_REQUESTS", 0))
+# seconds that a stopping worker waits for the requests in progress
+SHUTDOWN_TIMEOUT = float(os.environ.get("KLINGONIA_SHUTDOWN_TIMEOUT", 30.0))
+# a worker that fails sooner than this after starting is restarted only after a delay
+MIN_WORKER_LIFETIME = 5.0
+
+def create_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.setblocking(False)
+    return sock
+
+def recycle_after(max_requests: int):
+    """
+    Returns a middleware that stops the worker gracefully after it has handled max_requests requests. The limit has
+    some jitter, so that workers started at the same time are not replaced at the same time.
+    """
+    limit = max_requests + random.randint(0, max_requests // 10)
+    count = 0
+    @web.middleware
+    async def middleware(request: web.Request, handler):
+        nonlocal count
+        count += 1
+        if count == limit:
+            logger.info("Worker %d handled %d requests, stopping", os.getpid(), count)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        return await handler(request)
+
+    return middleware
+
+def run_worker(make_app: Callable[[], web.Application], sock: socket.socket):
+    # the parent downloads updates and loads new versions
+    reload.RELOAD_INTERVAL = 0
+    reload.UPDATE_INTERVAL = 0
+    for signum in [signal.SIGTERM, signal.SIGINT]:
+        signal.signal(signum, signal.SIG_DFL)
+
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    app = make_app()
+    if MAX_REQUESTS > 0:
+        app.middlewares.append(recycle_after(MAX_REQUESTS))
+
+    web.run_app(app, sock=sock, shutdown_timeout=SHUTDOWN_TIMEOUT, print=None)
+
+def serve(make_app: Callable[[], web.Application], prepare: Callable[[ModuleType], None], host: str, port: int, workers: int):
+    """
+    Runs the server in `workers` processes until the parent receives SIGTERM or SIGINT. `prepare` is called with
+    new dictionary modules before they are used (see reload.reload_dictionary).
+    """
+    sock = create_socket(host, port)
+    logger.info("Listening on %s:%d with %d workers", host, port, workers)
+    children: Dict[int, float] = {}
+    # workers that are being replaced and must not be restarted
+    retiring: Set[int] = set()
+    flags = {"stop": False, "replace": False}
+    def handle_stop(signum, frame):
+        flags["stop"] = True
+
+    def handle_replace(signum, frame):
+        flags["replace"] = True
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+    signal.signal(signal.SIGHUP, handle_replace)
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                run_worker(make_app, sock)
+                status = 0
+
+            except:
+                logger.exception("Worker %d failed", os.getpid(), exc_info=sys.exc_info())
+
+            finally:
+                os._exit(status)
+
+        children[pid] = time.monotonic()
+
+    def spawn_all():
+        # indexes that are loaded lazily from the snapshot would be loaded again by each worker
+        reload.current().load_all_sections()
+        # objects that exist before forking are never collected, so the workers do not touch their pages
+        gc.collect()
+        gc.freeze()
+        for _ in range(workers):
+            spawn()
+
+    def replace_all():
+        old = [pid for pid in children if pid not in retiring]
+        spawn_all()
+        for pid in old:
+            retiring.add(pid)
+            os.kill(pid, signal.SIGTERM)
+
+    spawn_all()
+    next_reload = time.monotonic() + reload.RELOAD_INTERVAL
+    next_update = time.monotonic() + reload.UPDATE_INTERVAL
+    stop_deadline = None
+    while children:
+        time.sleep(0.2)
+        while children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+
+            started = children.pop(pid)
+            if pid in retiring:
+                retiring.discard(pid)
+                continue
+
+            if flags["stop"]:
+                continue
+
+            if status != 0:
+                code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+                logger.warning("Worker %d exited with status %d", pid, code)
+                if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                    time.sleep(1.0)
+
+            spawn()
+
+        now = time.monotonic()
+        if flags["stop"]:
+            if stop_deadline is None:
+                logger.info("Stopping %d workers", len(children))
+                stop_deadline = now + SHUTDOWN_TIMEOUT + 5
+                for pid in children:
+                    os.kill(pid, signal.SIGTERM)
+
+            elif now > stop_deadline:
+                for pid in children:
+                    os.kill(pid, signal.SIGKILL)
+
+            continue
+
+        if flags["replace"]:
+            flags["replace"] = False
+            logger.info("Replacing the workers")
+            replace_all()
+
+        try:
+            if reload.UPDATE_INTERVAL > 0 and now >= next_update:
+                next_update = now + reload.UPDATE_INTERVAL
+                yajwiz.update_dictionary()
+
+            if reload.RELOAD_INTERVAL > 0 and now >= next_reload:
+                next_reload = now + reload.RELOAD_INTERVAL
+                gc.unfreeze()
+                if reload.reload_dictionary(prepare):
+                    replace_all()
+
+                else:
+                    gc.freeze()
+
+        except:
+            logger.exception("Error while reloading the dictionary", exc_info=sys.exc_info())
+            gc.freeze()
+
+    sock.close()
+    logger.info("All workers have stopped")
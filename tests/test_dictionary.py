@@ -0,0 +1,22 @@
+import pytest
+
+from klingonia import dictionary
+
+@pytest.mark.parametrize("query", ["tlh:[", "NOT tlh:[", "NOT tlh:[ OR pos:v", "NOT (en:ship tlh:\"(\")"])
+def test_invalid_term_fails_query(query):
+    assert dictionary.dictionary_query(query, "en", "html") == []
+    assert dictionary.explain_query(query, "en")["errors"]
+
+def test_deeply_nested_query_fails():
+    query = "".join("a OR (" for _ in range(150)) + "b"
+    assert dictionary.dictionary_query(query, "en", "html") == []
+    assert dictionary.compile_query(dictionary.normalize_query(query), "en").errors
+
+def test_chained_not_fails():
+    query = "NOT " * 250 + "a"
+    assert dictionary.dictionary_query(query, "en", "html") == []
+    assert dictionary.explain_query(query, "en")["errors"]
+
+def test_nesting_within_limit():
+    depth = dictionary.MAX_QUERY_DEPTH
+    assert dictionary.dictionary_query("NOT " * depth + "pos:v", "en", "html") == dictionary.dictionary_query("pos:v", "en", "html")
@@ -0,0 +1,20 @@
+import random
+from typing import List
+
+import pytest
+
+from benchmarks.xifan import dictionary_texts, fix_xifan_reference
+from klingonia.dictionary import fix_xifan, fix_xifan_all
+
+def random_texts(n: int, seed: int = 0) -> List[str]:
+    """
+    Random strings of the letters that the conversion uses.
+    """
+    rng = random.Random(seed)
+    return ["".join(rng.choice("cghlntxfidsHI' \n") for _ in range(rng.randint(0, 8))) for _ in range(n)]
+
+@pytest.mark.parametrize("texts", [dictionary_texts(), random_texts(100000)], ids=["dictionary", "random"])
+def test_fix_xifan_matches_reference(texts):
+    expected = [fix_xifan_reference(text) for text in texts]
+    assert fix_xifan_all(texts) == expected
+    assert [fix_xifan(text) for text in texts] == expected